@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from SAR_lib import SAR_Project, iter_json_array, tokenize_spans
+
+
+"""
+Benchmark del indexador y del buscador.
+
+Por cada corpus (corpora/<año>.zip) y modo de indexado se mide:
+    build_s      -> tiempo de SAR_Indexer.py (indexar + guardar), en un proceso aparte
+    peak_rss_mb  -> memoria maxima (RSS) de ese proceso (VmHWM, medido por el propio proceso)
+    index_mb     -> tamaño del indice en disco
+    load_s       -> tiempo de SAR_Project.load
+    queries      -> p50/p95/p99 (ms) de solve_query sobre results/queries_minimo.txt y
+                    results/queries_full.txt (si el modo lo permite), con la cache de
+                    consultas desactivada
+
+Con -k se mide ademas el tokenizador (MB/s de texto) sobre todas las secciones de las noticias,
+comparado con el original (sustituir lo no alfanumerico por espacios y partir), y se comprueba
+que los tokens son los mismos.
+
+El resultado se guarda en json. Si se da una baseline (un json anterior) se compara con ella
+y se marcan como regresion las metricas que empeoran mas de la tolerancia; en ese caso el
+programa termina con codigo 1.
+"""
+
+# modo -> (opciones de SAR_Indexer.py, ficheros de consultas)
+# queries_full.txt tiene campos y frases, solo se puede resolver con -M -O
+MODES = {
+    "plain": ([], ("minimo",)),
+    "stemming": (["-S"], ("minimo",)),
+    "positional": (["-O"], ("minimo",)),
+    "multifield": (["-M", "-O"], ("minimo", "full")),
+}
+
+QUERY_FILES = ("minimo", "full")
+
+# diferencias absolutas por debajo de estas no cuentan como regresion (ruido de medida)
+MIN_DELTA = {"build_s": 0.5, "peak_rss_mb": 5, "index_mb": 0.1, "load_s": 0.05, "ms": 0.2, "mb_s": 1}
+
+# metricas en las que empeorar es bajar
+HIGHER_IS_BETTER = ("mb_s",)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# el proceso hijo ejecuta SAR_Indexer.py y al terminar escribe su VmHWM (KB) en un fichero.
+# El ru_maxrss de wait4 no sirve: el hijo hereda el maximo del padre al hacer fork y no lo
+# pierde con exec, asi que saldria el de este proceso si es mayor. VmHWM es de la memoria del
+# programa y empieza de cero con exec.
+_CHILD = """
+import os, runpy, sys
+report, script = sys.argv[1], sys.argv[2]
+sys.argv = sys.argv[2:]
+sys.path.insert(0, os.path.dirname(script))
+try:
+    runpy.run_path(script, run_name="__main__")
+finally:
+    with open("/proc/self/status") as fh:
+        hwm = [line.split()[1] for line in fh if line.startswith("VmHWM:")]
+    with open(report, "w") as fh:
+        fh.write(hwm[0] if hwm else "")
+"""
+
+
+def read_queries(filename):
+    with open(filename, encoding='utf-8') as fh:
+        return [line.split('\t')[0] for line in fh.read().split('\n')
+                if len(line) > 0 and not line.startswith('#')]
+
+
+def percentile(samples, p):
+    # percentil por rango mas cercano
+    samples = sorted(samples)
+    k = max(0, min(len(samples) - 1, -(-len(samples) * p // 100) - 1))
+    return samples[int(k)]
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def build(newsdir, index, flags):
+    """
+    Ejecuta SAR_Indexer.py en un proceso hijo.
+
+    return: (segundos, RSS maximo en MB, None si el sistema no tiene /proc)
+    """
+    report = index + ".rss"
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", _CHILD, report, os.path.join(HERE, "SAR_Indexer.py"),
+                           newsdir, index] + flags, stdout=subprocess.DEVNULL, cwd=os.path.dirname(index))
+    t = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise Exception("SAR_Indexer.py {} ha fallado ({})".format(" ".join(flags), proc.returncode))
+    with open(report) as fh:
+        kb = fh.read()
+    os.remove(report)
+    return t, int(kb) / 1024 if kb else None
+
+
+def bench_queries(searcher, queries, repeat):
+    # una pasada previa descarta las consultas que el indice no puede resolver
+    # (p.ej. date:, que no se indexa) y calienta el mmap del indice
+    valid = []
+    for query in queries:
+        try:
+            searcher.solve_query(query)
+            valid.append(query)
+        except Exception:
+            pass
+    samples = []
+    for _ in range(repeat):
+        for query in valid:
+            t0 = time.perf_counter()
+            len(searcher.solve_query(query)[0])
+            samples.append(1000 * (time.perf_counter() - t0))
+    return {"n": len(valid), "skipped": len(queries) - len(valid), "p50_ms": percentile(samples, 50),
+            "p95_ms": percentile(samples, 95), "p99_ms": percentile(samples, 99)}
+
+
+def bench_tokenizer(newsdir, repeat):
+    """
+    Throughput (MB/s de texto en utf-8, el mejor de "repeat" pasadas) de cada tokenizador sobre
+    todas las secciones de las noticias de "newsdir".
+    """
+    texts = []
+    for root, _, names in os.walk(newsdir):
+        for name in sorted(names):
+            if name.endswith(".json"):
+                with open(os.path.join(root, name)) as fh:
+                    for noticia in iter_json_array(fh):
+                        texts.extend(noticia[section] for section, _ in SAR_Project.fields)
+    mb = sum(len(text.encode("utf-8")) for text in texts) / 2**20
+    old = re.compile(r"\W+")
+    searcher = SAR_Project()
+    tokenizers = {
+        "sub_split": lambda text: old.sub(' ', text.lower()).split(), # tokenize original
+        "findall": searcher.tokenize,
+        "finditer_spans": lambda text: tokenize_spans(text)[0],
+    }
+    reference = [tokenizers["sub_split"](text) for text in texts]
+    res = {}
+    for name, tokenize in tokenizers.items():
+        if [tokenize(text) for text in texts] != reference:
+            raise Exception("el tokenizador {} no da los mismos tokens".format(name))
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for text in texts:
+                tokenize(text)
+            t = time.perf_counter() - t0
+            best = t if best is None else min(best, t)
+        res[name] = {"mb_s": mb / best}
+    print("  tokenizer   {:.1f}MB, {} tokens, same tokens: ".format(mb, sum(map(len, reference))) +
+          "  ".join("{} {:.1f}MB/s".format(name, r["mb_s"]) for name, r in res.items()))
+    return res
+
+
+def bench_corpus(zipname, workdir, modes, repeat, tokenizer=False):
+    newsdir = os.path.join(workdir, "news")
+    with zipfile.ZipFile(zipname) as zf:
+        zf.extractall(newsdir)
+    res = {}
+    if tokenizer:
+        res["tokenizer"] = bench_tokenizer(newsdir, repeat)
+    queries = {name: read_queries(os.path.join(HERE, "results", "queries_{}.txt".format(name)))
+               for name in QUERY_FILES}
+    for mode in modes:
+        index = os.path.join(workdir, "index_" + mode)
+        flags, files = MODES[mode]
+        build_s, rss = build(newsdir, index, flags)
+        t0 = time.perf_counter()
+        searcher = SAR_Project.load(index)
+        load_s = time.perf_counter() - t0
+        searcher.set_cache_size(0)
+        searcher.set_stemming(mode == "stemming")
+        res[mode] = {
+            "build_s": build_s,
+            "peak_rss_mb": rss,
+            "index_mb": dir_size(index) / 2**20,
+            "load_s": load_s,
+            "queries": {name: bench_queries(searcher, queries[name], repeat) for name in files},
+        }
+        print("  {:<11} build {:6.2f}s  rss {:>6}MB  size {:6.2f}MB  load {:5.3f}s  ".format(
+            mode, build_s, "-" if rss is None else "{:.1f}".format(rss), res[mode]["index_mb"], load_s) +
+            "  ".join("{} p50/p95/p99 {:.2f}/{:.2f}/{:.2f}ms".format(name, q["p50_ms"], q["p95_ms"], q["p99_ms"])
+                      for name, q in res[mode]["queries"].items()))
+    return res
+
+
+def flatten(results):
+    # {"2015/plain/build_s": 1.2, "2015/plain/queries/full/p95_ms": 0.3, ...}
+    flat = {}
+    pending = [("", results)]
+    while pending:
+        prefix, value = pending.pop()
+        if isinstance(value, dict):
+            pending.extend((prefix + "/" + k if prefix else k, v) for k, v in value.items())
+        elif isinstance(value, (int, float)) and prefix.rsplit("/", 1)[-1] not in ("n", "skipped"):
+            flat[prefix] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """
+    return: lista de (metrica, baseline, actual) que empeoran mas de "tolerance" (fraccion)
+    """
+    current = flatten(results)
+    regressions = []
+    for key, old in sorted(flatten(baseline).items()):
+        new = current.get(key)
+        if new is None:
+            continue
+        metric = key.rsplit("/", 1)[1]
+        floor = MIN_DELTA["ms"] if metric.endswith("_ms") else MIN_DELTA.get(metric, 0)
+        if metric in HIGHER_IS_BETTER:
+            worse = new < old * (1 - tolerance) and old - new > floor
+        else:
+            worse = new > old * (1 + tolerance) and new - old > floor
+        if worse:
+            regressions.append((key, old, new))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark index build and query latency.')
+    parser.add_argument('-c', '--corpora', dest='corpora', type=str, default=os.path.join(HERE, "corpora"),
+                        help='directory with the <year>.zip corpora.')
+    parser.add_argument('-y', '--years', dest='years', nargs='+', default=["2015", "2016"],
+                        help='corpora to benchmark.')
+    parser.add_argument('-m', '--modes', dest='modes', nargs='*', default=list(MODES), choices=list(MODES),
+                        help='indexing modes.')
+    parser.add_argument('-k', '--tokenizer', dest='tokenizer', action='store_true', default=False,
+                        help='also measure the tokenizer throughput.')
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                        help='times each query file is run.')
+    parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+                        help='json file to write the results to.')
+    parser.add_argument('-b', '--baseline', dest='baseline', type=str, default=None,
+                        help='json file with previous results to compare with.')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+                        help='relative slowdown flagged as a regression (default 0.2).')
+    args = parser.parse_args()
+
+    results = {}
+    for year in args.years:
+        zipname = os.path.join(args.corpora, year + ".zip")
+        if not os.path.exists(zipname):
+            print("Skipping {}: {} not found".format(year, zipname))
+            continue
+        print("Corpus {}:".format(year))
+        with tempfile.TemporaryDirectory() as workdir:
+            results[year] = bench_corpus(zipname, workdir, args.modes, args.repeat, args.tokenizer)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline, args.tolerance)
+        for key, old, new in regressions:
+            print("REGRESSION {}: {:.3f} -> {:.3f} ({:+.0f}%)".format(key, old, new, 100 * (new / old - 1) if old else 0))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {}".format(args.baseline))
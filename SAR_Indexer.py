@@ -1,5 +1,5 @@
 import argparse
-import pickle
+import os
 import sys
 import time
 
@@ -13,7 +13,7 @@ if __name__ == "__main__":
                         help='directory with the news.')
 
     parser.add_argument('index', metavar='index', type=str,
-                        help='name of the file to save the project object.')
+                        help='name of the directory to save the index.')
 
     parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
                     help='compute stem index.')
@@ -27,18 +27,27 @@ if __name__ == "__main__":
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False,
                     help='compute positional index.')
 
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=1,
+                    help='number of processes used to index the news.')
+
+    parser.add_argument('-U', '--update', dest='update', action='store_true', default=False,
+                    help='update an existing index with the new or modified files.')
+
 
     args = parser.parse_args()
 
     newsdir = args.newsdir
     indexfile = args.index
 
-    indexer = SAR_Project()
     t0 = time.time()
-    indexer.index_dir(newsdir, **vars(args))
+    if args.update and os.path.exists(indexfile):
+        indexer = SAR_Project.load(indexfile)
+        indexer.update_dir(newsdir, **vars(args))
+    else:
+        indexer = SAR_Project()
+        indexer.index_dir(newsdir, **vars(args))
     t1 = time.time()
-    with open(indexfile, 'wb') as fh:
-            pickle.dump(indexer, fh)
+    indexer.save(indexfile)
     t2 = time.time()
     indexer.show_stats()
     print("Time indexing: %2.2fs." % (t1 - t0))
@@ -2,10 +2,11 @@
 
 
 import argparse
-import pickle
 import sys
+import time
 
 from SAR_lib import SAR_Project
+from SAR_profile import Profiler
 
 
 def syntax():
@@ -20,7 +21,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Search the index.')
 
     parser.add_argument('index', metavar='index', type=str,
-                        help='name of the file with the index object.')
+                        help='name of the directory with the index.')
 
     parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
                     help='use stem index by default.')
@@ -40,6 +41,21 @@ if __name__ == "__main__":
     parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False,
                     help='rank results. Does not apply with -C and -T options.')
 
+    parser.add_argument('-E', '--explain', dest='explain', action='store_true', default=False,
+                    help='show the plan of each query with the estimated and actual number of results.')
+
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=None,
+                    help='maximum number of query results kept in the cache (0 disables it).')
+
+    parser.add_argument('--cache-stats', dest='cache_stats', action='store_true', default=False,
+                    help='show the query cache hits and misses at the end.')
+
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+                    help='show the time of each stage and the postings and bytes processed by each query, and a summary at the end.')
+
+    parser.add_argument('--profile-file', dest='profile_file', type=str, default=None,
+                    help='write the profile summary (with the time histograms) as json to this file.')
+
     # ALGORITMICA
     parser.add_argument('-t', '--threshold', type=int, dest="threshold", default=2, help='threshold to suggest terms')
     parser.add_argument('-a', '--algorithm', type=str, default="levenshtein",dest="algorithm", help='algortithm to suggest terms')
@@ -51,18 +67,28 @@ if __name__ == "__main__":
                     help='file with queries.')
     group1.add_argument('-T', '--test', dest='test', metavar= 'test', type=str, action='store',
                     help='file with queries and results, for testing.')
+    group1.add_argument('-B', '--batch', dest='batch', metavar= 'batch', type=str, action='store',
+                    help='file with queries, solved together; prints the number of results and the time of each one.')
+
+    parser.add_argument('-W', '--workers', dest='workers', type=int, default=1,
+                    help='number of processes used with -B.')
 
     args = parser.parse_args()
 
-    with open(args.index, 'rb') as fh:
-        searcher = pickle.load(fh)
+    searcher = SAR_Project.load(args.index)
 
     searcher.set_stemming(args.stem)
     searcher.set_ranking(args.rank)
+    searcher.set_explain(args.explain)
+    if args.cache_size is not None:
+        searcher.set_cache_size(args.cache_size)
     searcher.set_showall(args.all)
     searcher.set_snippet(args.snippet)
     searcher.set_algorithm(args.algorithm)
     searcher.set_threshold(args.threshold)
+    profiler = None
+    if args.profile or args.profile_file is not None:
+        profiler = Profiler(verbose=args.profile).attach(searcher)
 
 
     # se debe contar o mostrar resultados?
@@ -88,6 +114,16 @@ if __name__ == "__main__":
                     print(line)
             print('\nParece que todo ha ido bien, buen trabajo!')
 
+    elif args.batch is not None:
+        # opt: -B, todas las queries del fichero de una vez
+        with open(args.batch, encoding='utf-8') as fh:
+            queries = [line.split('\t')[0] for line in fh.read().split('\n')
+                       if len(line) > 0 and not line.startswith('#')]
+        t0 = time.time()
+        for query, result, t in searcher.solve_batch(queries, args.workers):
+            print("%s\t%d\t%.2f ms" % (query, len(result), 1000 * t))
+        print("%d queries in %.2fs" % (len(queries), time.time() - t0))
+
     elif args.query is not None:
         # opt: -Q, una query pasada como argumento
         fnc(args.query) # searcher.solve_and_show(args.query)
@@ -108,3 +144,12 @@ if __name__ == "__main__":
         while query != "":
             fnc(query)
             query = input("query:")
+
+    if args.cache_stats:
+        print(searcher.cache.stats())
+
+    if profiler is not None:
+        if args.profile:
+            print("\n".join(profiler.summary()))
+        if args.profile_file is not None:
+            profiler.dump(args.profile_file)
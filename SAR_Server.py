@@ -0,0 +1,182 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from SAR_lib import SAR_Project
+
+
+"""
+Servidor HTTP de consultas: carga el indice una vez y responde en JSON.
+
+    GET  /count?q=QUERY                         -> {"query", "count", "time_ms"}
+    GET  /search?q=QUERY[&stem=1&rank=1&all=1&snippet=1]
+                                                -> {"query", "count", "results": [...], "time_ms"}
+    POST /batch  {"queries": [...], "stem": 0}  -> {"results": [{"query", "count", "time_ms"}], "time_ms"}
+
+Las peticiones se reparten entre un numero fijo de hilos (-w). Las opciones de busqueda son
+atributos de SAR_Project (stemming, ranking...) y la cache de consultas no es thread-safe,
+asi que cada hilo tiene su propio SAR_Project cargado del indice (los ficheros del indice se
+abren con mmap y se comparten) y no hace falta ningun lock. El log de cada peticion lleva el
+tiempo de la consulta.
+"""
+
+
+def _flag(params, name):
+    return params.get(name, ["0"])[0] not in ("0", "", "false")
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+
+    server_version = "SAR_Server/1.0"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        query = params.get("q", [""])[0]
+        if url.path == "/count":
+            self.answer(lambda s: self.count(s, query), stem=_flag(params, "stem"))
+        elif url.path == "/search":
+            options = {name: _flag(params, name) for name in ("stem", "rank", "all", "snippet")}
+            self.answer(lambda s: self.search(s, query, options["snippet"]), **options)
+        else:
+            self.send_json(404, {"error": "unknown path {}".format(url.path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/batch":
+            self.send_json(404, {"error": "unknown path {}".format(url.path)})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            queries = [str(q) for q in body.get("queries", [])]
+        except (ValueError, AttributeError) as e:
+            self.send_json(400, {"error": "invalid body: {}".format(e)})
+            return
+        self.answer(lambda s: {"results": [{"query": q, "count": len(r), "time_ms": 1000 * t}
+                                           for q, r, t in s.solve_batch(queries)]},
+                    stem=bool(body.get("stem")))
+
+    @staticmethod
+    def count(searcher, query):
+        query, count = searcher.count(query)
+        return {"query": query, "count": count}
+
+    @staticmethod
+    def search(searcher, query, snippet):
+        query, count, ids = searcher.search(query)
+        results = []
+        for news_id in ids:
+            article = searcher.get_news(news_id)
+            item = {"news_id": news_id, "date": article["date"], "title": article["title"],
+                    "keywords": article["keywords"]}
+            if snippet:
+                item["snippet"] = searcher.make_snippet(news_id, article, query, searcher.SNIPPET_TOKENS)
+            results.append(item)
+        return {"query": query, "count": count, "results": results}
+
+    def answer(self, solve, stem=False, rank=False, all=False, snippet=False):
+        # el SAR_Project de este hilo, ver SearchServer.work
+        searcher = self.server.local.searcher
+        searcher.set_stemming(stem)
+        searcher.set_ranking(rank)
+        searcher.set_showall(all)
+        searcher.set_snippet(snippet)
+        t0 = time.perf_counter()
+        try:
+            res = solve(searcher)
+            code = 200
+        except Exception as e:
+            res = {"error": "{}: {}".format(type(e).__name__, e)}
+            code = 400
+        t1 = time.perf_counter()
+        res["time_ms"] = 1000 * (t1 - t0)
+        self.send_json(code, res)
+        self.log_message('"%s" %d query=%.2fms', self.path, code, 1000 * (t1 - t0))
+
+    def send_json(self, code, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_request(self, code='-', size='-'):
+        # answer ya deja una linea por peticion con los tiempos
+        if code != 200 and code != 400:
+            super().log_request(code, size)
+
+
+class SearchServer(HTTPServer):
+    """
+    Servidor con un hilo por cada SAR_Project de "searchers": el bucle de serve_forever deja
+    las conexiones en una cola y cada hilo las atiende con su SAR_Project (self.local.searcher).
+    """
+
+    def __init__(self, address, searchers):
+        super().__init__(address, SearchHandler)
+        self.requests = queue.Queue()
+        self.local = threading.local()
+        self.workers = [threading.Thread(target=self.work, args=(searcher,), daemon=True)
+                        for searcher in searchers]
+        for worker in self.workers:
+            worker.start()
+
+    def work(self, searcher):
+        self.local.searcher = searcher
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            # como socketserver.ThreadingMixIn.process_request_thread
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.requests.put(None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve queries over an index.')
+    parser.add_argument('index', metavar='index', type=str,
+                        help='index directory.')
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+                        help='address to listen on.')
+    parser.add_argument('-p', '--port', dest='port', type=int, default=8000,
+                        help='port to listen on.')
+    parser.add_argument('-t', '--threshold', type=int, dest="threshold", default=2, help='threshold to suggest terms')
+    parser.add_argument('-a', '--algorithm', type=str, default="levenshtein",dest="algorithm", help='algortithm to suggest terms')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=4,
+                        help='number of threads, each with its own copy of the searcher.')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    searchers = []
+    for _ in range(max(1, args.workers)):
+        searcher = SAR_Project.load(args.index)
+        searcher.set_algorithm(args.algorithm)
+        searcher.set_threshold(args.threshold)
+        searchers.append(searcher)
+    server = SearchServer((args.host, args.port), searchers)
+    print("Index loaded in %.2fs (%d workers), listening on http://%s:%d" % (
+        time.time() - t0, len(searchers), args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
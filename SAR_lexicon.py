@@ -0,0 +1,189 @@
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+from SAR_postings import vbyte_decode, vbyte_encode
+
+
+"""
+Lexicon global del indice: todos los terminos de todas las tablas (campos e indices de stems),
+ordenados y guardados una sola vez. El id de un termino es su posicion en el orden, asi que
+las tablas de SAR_storage guardan ids (uint32) en vez de cadenas y los terminos con un mismo
+prefijo son un rango de ids.
+
+Formato (front coding por bloques de BLOCK terminos):
+
+    n, block, nblocks, 0                    (uint32)
+    block_offs[nblocks + 1]                 (uint64, offset de cada bloque en los datos)
+    datos: por bloque, el primer termino entero  -> longitud, bytes (utf-8)
+           y cada uno de los siguientes           -> bytes en comun con el anterior,
+                                                     longitud del resto, resto
+
+Buscar un termino es una busqueda binaria sobre el primer termino de cada bloque (se decodifican
+todos la primera vez, uno de cada BLOCK terminos) y un recorrido de un solo bloque. El orden es
+el de los bytes en utf-8, que es el mismo que el de las cadenas.
+"""
+
+BLOCK = 16
+
+# terminos buscados que se recuerdan (una consulta busca cada termino al estimar, al evaluar
+# y una vez por campo), se vacia al llenarse
+ID_CACHE_SIZE = 4096
+
+# bloques decodificados que se recuerdan (los comodines leen los terminos de sus rotaciones
+# dispersos por todo el lexicon), se vacia al llenarse
+BLOCK_CACHE_SIZE = 4096
+
+_HEADER = struct.Struct("<IIII")
+
+
+def _common_prefix(a, b):
+    n = min(len(a), len(b))
+    k = 0
+    while k < n and a[k] == b[k]:
+        k += 1
+    return k
+
+
+class Lexicon:
+
+    def __init__(self, buf, offset=0):
+        """
+        Abre un lexicon construido con "build" que empieza en "buf[offset]" (bytes o mmap).
+        """
+        self.buf = buf
+        self.n, self.block, self.nblocks, _ = _HEADER.unpack_from(buf, offset)
+        start = offset + _HEADER.size
+        width = 8 * (self.nblocks + 1)
+        if sys.byteorder == "little":
+            self.block_offs = memoryview(buf)[start:start + width].cast("Q")
+        else:
+            self.block_offs = array("Q", buf[start:start + width])
+            self.block_offs.byteswap()
+        self.data = start + width
+        self.nbytes = _HEADER.size + width + self.block_offs[self.nblocks]
+        self._heads = None      # primer termino de cada bloque
+        self._blocks = {}       # bloque -> terminos de los ultimos decodificados
+        self._ids = {}          # termino -> id de los ultimos buscados
+
+    @staticmethod
+    def build(terms, block=BLOCK):
+        """
+        param:  "terms": terminos ordenados y sin repetir
+
+        return: bytes del lexicon
+        """
+        data = bytearray()
+        block_offs = array("Q")
+        prev = b""
+        n = 0
+        for term in terms:
+            b = term.encode("utf-8")
+            if n % block == 0:
+                block_offs.append(len(data))
+                vbyte_encode((len(b),), data)
+                data += b
+            else:
+                k = _common_prefix(prev, b)
+                vbyte_encode((k, len(b) - k), data)
+                data += b[k:]
+            prev = b
+            n += 1
+        block_offs.append(len(data))
+        if sys.byteorder != "little":
+            block_offs.byteswap()
+        return _HEADER.pack(n, block, len(block_offs) - 1, 0) + block_offs.tobytes() + bytes(data)
+
+    def _varint(self, pos):
+        # casi todas las longitudes caben en un byte
+        b = self.buf[pos]
+        if b >= 128:
+            return b - 128, pos + 1
+        (v,), pos = vbyte_decode(self.buf, pos, 1)
+        return v, pos
+
+    def _decode_block(self, b):
+        terms = self._blocks.get(b)
+        if terms is not None:
+            return terms
+        buf = self.buf
+        pos = self.data + self.block_offs[b]
+        length, pos = self._varint(pos)
+        prev = buf[pos:pos + length]
+        pos += length
+        terms = [prev]
+        for _ in range(min(self.block, self.n - b * self.block) - 1):
+            k, pos = self._varint(pos)
+            length, pos = self._varint(pos)
+            prev = prev[:k] + buf[pos:pos + length]
+            pos += length
+            terms.append(prev)
+        if len(self._blocks) >= BLOCK_CACHE_SIZE:
+            self._blocks.clear()
+        self._blocks[b] = terms
+        return terms
+
+    def _block_of(self, key):
+        # ultimo bloque cuyo primer termino es <= key (0 si key va antes que todos)
+        if self._heads is None:
+            heads = []
+            for b in range(self.nblocks):
+                length, pos = self._varint(self.data + self.block_offs[b])
+                heads.append(self.buf[pos:pos + length])
+            self._heads = heads
+        return max(0, bisect_right(self._heads, key) - 1)
+
+    def lower_bound(self, key):
+        """
+        return: id del primer termino >= "key" (bytes en utf-8), o len(self) si no hay
+        """
+        if self.n == 0:
+            return 0
+        b = self._block_of(key)
+        for k, term in enumerate(self._decode_block(b)):
+            if term >= key:
+                return b * self.block + k
+        return min(self.n, (b + 1) * self.block)
+
+    def id(self, term):
+        """
+        return: id de "term" o -1 si no esta en el lexicon
+        """
+        i = self._ids.get(term)
+        if i is not None:
+            return i
+        key = term.encode("utf-8")
+        i = self.lower_bound(key)
+        if i >= self.n or self.term_bytes(i) != key:
+            i = -1
+        if len(self._ids) >= ID_CACHE_SIZE:
+            self._ids.clear()
+        self._ids[term] = i
+        return i
+
+    def term_bytes(self, i):
+        return self._decode_block(i // self.block)[i % self.block]
+
+    def term(self, i):
+        return self.term_bytes(i).decode("utf-8")
+
+    __getitem__ = term # lexicon[id] -> termino, como una lista ordenada de los terminos
+
+    def prefix_range(self, prefix):
+        """
+        return: (lo, hi), los ids de los terminos que empiezan por "prefix" son lo .. hi-1
+        """
+        key = prefix.encode("utf-8")
+        return self.lower_bound(key), self.lower_bound(key + b"\xff") # 0xff no aparece en utf-8
+
+    def __contains__(self, term):
+        return self.id(term) >= 0
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for b in range(self.nblocks):
+            for term in self._decode_block(b):
+                yield term.decode("utf-8")
@@ -1,10 +1,22 @@
+import bisect
+import hashlib
+import heapq
 import json
+import math
+import multiprocessing
+from array import array
 from nltk.stem.snowball import SnowballStemmer
 import os
 import re
-import shlex
-import spellsuggest
-from enum import Enum, auto
+import time
+from collections import Counter, defaultdict
+from SAR_postings import PostingList, CompressedPostingList, BitmapPostingList, NotPostingList, PostingCursor, gallop, merge_postings, pack_table, unpack_table
+from SAR_permuterm import PermutermIndex, has_wildcard
+from SAR_spell import TrieSuggester
+from SAR_storage import DocStore, save_index, load_index, save_suggester, load_suggester
+from SAR_query import AND, NOT, OR, TERM, QueryCache, canonical, count_nodes, parse_query, plan, explain
+
+POSTING_TYPES = (PostingList, CompressedPostingList, BitmapPostingList)
 
 class SAR_Project:
     """
@@ -28,6 +40,30 @@ class SAR_Project:
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
 
+    # los terminos que aparecen en al menos esta fraccion de las noticias guardan su conjunto de
+    # documentos como bitmap (BitmapPostingList). Con 1/16 el bitmap (N/8 bytes) ocupa como mucho
+    # lo mismo que 2 bytes por posting
+    BITMAP_RATIO = 1 / 16
+
+    # tokens de los snippets
+    SNIPPET_TOKENS = 20
+
+    # parametros de BM25 para el ranking
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    # numero maximo de terminos en los que se expande un comodin (se quedan los mas frecuentes)
+    MAX_WILDCARD_TERMS = 500
+
+    # numero maximo de resultados de consultas y subconsultas en la cache
+    QUERY_CACHE_SIZE = 256
+
+    # atributos que no se guardan con el indice (el vocabulario sale de las tablas, ver get_vocabulary)
+    TRANSIENT_STATE = ("cache", "_universe", "path", "_suggester", "_suggestions", "_postings", "_snippet_postings", "vocabulary")
+
+    # valores por termino que se guardan como columnas de las tablas del indice (SAR_storage)
+    COLUMNS = ("weight", "max_score")
+
 
     def __init__(self):
         """
@@ -54,22 +90,32 @@ class SAR_Project:
                     "summary": {},
                     "keywords": {}
         } # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
-        self.ptindex = {} # hash para el indice permuterm.
-        self.docs = {} # diccionario de terminos --> clave: entero(docid),  valor: ruta del fichero.
-        self.weight = {} # hash de terminos para el pesado, ranking de resultados. puede no utilizarse
+        self.ptindex = {} # hash para el indice permuterm --> clave: campo, valor: PermutermIndex
+        self.docs = {} # diccionario de terminos --> clave: entero(docid),  valor: (ruta del fichero, mtime, sha1 del contenido).
+        self.weight = {} # hash de terminos para el pesado --> clave: campo, valor: {termino: idf}. Ver make_weights
+        self.avgdl = {} # longitud media (en tokens) de cada campo
+        self.max_score = {} # --> clave: campo, valor: {termino: maxima puntuacion BM25 del termino en una noticia}, para WAND
+        self.doc_len = {section: array('I', [0]) for section in self.index} # longitud de cada campo de cada noticia, indexada por newid
         self.news = {} # hash de noticias --> clave entero (newid), valor: la info necesaria para diferencia la noticia dentro de su fichero
-        self.tokenizer = re.compile("\W+") # expresion regular para hacer la tokenizacion
+        self.store = DocStore() # campos de cada noticia para mostrar los resultados, accesibles por newid
         self.stemmer = SnowballStemmer('spanish') # stemmer en castellano
         self.show_all = False # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False # valor por defecto, se cambia con self.set_stemming()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
+        self.explain = False # valor por defecto, se cambia con self.set_explain()
+        self.cache = QueryCache(self.QUERY_CACHE_SIZE) # resultados de consultas y subconsultas, se cambia con self.set_cache_size()
         self.sections = ["article"]
 
         #ALGORITMICA
-        self.vocabulary = []
+        self.vocabulary = set() # palabras de todos los campos, se actualiza al indexar cada noticia
         self.threshold = 2
         self.algorithm = "lev"
+        self.path = None # directorio del indice cargado, de ahi se lee el corrector
+        self._suggester = None # SAR_spell.TrieSuggester, se carga la primera vez que hace falta
+        self._suggestions = {} # (termino, threshold, algorithm) -> sugerencia
+        self._postings = None # (campo, termino, stemming) -> posting list, solo durante solve_batch
+        self._snippet_postings = None # ((query, stemming), posting lists) de la ultima query con snippets
     ###############################
     ###                         ###
     ###      CONFIGURACION      ###
@@ -141,6 +187,31 @@ class SAR_Project:
         self.use_ranking = v
 
 
+    def set_explain(self, v):
+        """
+
+        Cambia el modo de mostrar el plan de las consultas.
+
+        input: "v" booleano.
+
+        si self.explain es True se mostrara el plan de cada consulta con el numero de resultados
+        estimado y el real de cada nodo
+
+        """
+        self.explain = v
+
+
+    def set_cache_size(self, n):
+        """
+
+        Cambia el numero maximo de entradas de la cache de consultas (0 la desactiva).
+
+        input: "n" entero.
+
+        """
+        self.cache = QueryCache(n)
+
+
 
 
     ###############################
@@ -162,24 +233,261 @@ class SAR_Project:
         self.positional = args['positional']
         self.stemming = args['stem']
         self.permuterm = args['permuterm']
+        workers = args.get('workers') or 1
+        if self.multifield:
+            self.sections = ['title', 'keywords', "article", 'summary'] # si es multifield se actualizan las secciones a indexar
         print("Retrieving information...")
-        for dir, subdirs, files in os.walk(root):
-            for filename in files:
-                if filename.endswith('.json'):
-                    fullname = os.path.join(dir, filename)
-                    self.index_file(fullname)
+        filenames = self.list_files(root)
+        if workers > 1:
+            self.index_parallel(filenames, workers)
+        else:
+            for fullname in filenames:
+                self.index_file(fullname)
         if self.stemming:
-            self.make_stemming()
+            self.make_stemming(workers)
+        self.compress_index()
+        self.make_weights()
+        if self.permuterm:
+            self.make_permuterm()
         print("Indexing complete!")
 
-        #ALGORITMICA
-        self.make_vocab()
-
         ##########################################
         ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
         ##########################################
 
 
+    def list_files(self, root):
+        """
+        Devuelve los ficheros .json que hay bajo "root", en el orden en el que los recorre os.walk.
+        Ese orden es el que fija los doc_id y news_id del indice.
+
+        """
+        filenames = []
+        for dir, subdirs, files in os.walk(root):
+            for filename in files:
+                if filename.endswith('.json'):
+                    filenames.append(os.path.join(dir, filename))
+        return filenames
+
+
+    def index_parallel(self, filenames, workers):
+        """
+        Indexa "filenames" con "workers" procesos.
+
+        Cada proceso indexa un trozo contiguo de la lista de ficheros en un indice parcial
+        (con ids locales que empiezan en 1) y aqui se fusionan en orden, desplazando los ids.
+        Como los trozos van en el orden de la lista, las posting lists fusionadas siguen
+        ordenadas por news_id y el indice es identico al del indexado secuencial.
+
+        """
+        nchunks = min(len(filenames), workers * 4)
+        if nchunks == 0:
+            return
+        size = -(-len(filenames) // nchunks)
+        config = (self.sections, self.positional)
+        shards = [(config, filenames[i:i + size]) for i in range(0, len(filenames), size)]
+        with multiprocessing.Pool(workers) as pool:
+            for partial in pool.imap(_index_shard, shards):
+                self.merge_partial(partial)
+
+
+    def merge_partial(self, partial):
+        """
+        Añade al final del indice un indice parcial construido por _index_shard.
+
+        """
+        docs, news, index, vocabulary, store, doc_len = partial
+        doc_shift = self.doc_id
+        news_shift = self.news_id
+        for doc_id, filename in docs.items():
+            self.docs[doc_id + doc_shift] = filename
+        for news_id, value in news.items():
+            self.news[news_id + news_shift] = value
+        self.doc_id += len(docs)
+        self.news_id += len(news)
+        for section, packed in index.items():
+            table = self.index[section]
+            for word, plist in unpack_table(packed):
+                current = table.get(word)
+                if current is None: # primera aparicion del termino, basta con desplazar los ids
+                    if news_shift:
+                        plist.ids = array('I', map(news_shift.__add__, plist.ids))
+                    table[word] = plist
+                else:
+                    current.extend_from(plist, shift=news_shift)
+        for section, lengths in doc_len.items():
+            self.doc_len[section].extend(lengths[1:])
+        self.vocabulary.update(vocabulary)
+        self.store.extend(store)
+
+
+    def update_dir(self, root, **args):
+        """
+        Actualiza un indice ya construido con los ficheros de "root" que son nuevos o han cambiado.
+
+        Un fichero ha cambiado si su mtime no coincide con el guardado en self.docs y su contenido
+        tampoco (sha1). Las noticias de un fichero cambiado se borran de las posting lists y el
+        fichero se vuelve a indexar como uno nuevo. Como los ids nuevos son mayores que todos los
+        existentes, sus postings se añaden al final de las listas sin reconstruir nada mas.
+
+        Las opciones de indexado (multifield, posicional, stemming) son las del indice cargado.
+
+        return: numero de ficheros indexados
+        """
+        workers = args.get('workers') or 1
+        known = {info[0]: doc_id for doc_id, info in self.docs.items()}
+
+        pending = []
+        removed = set()
+        for filename in self.list_files(root):
+            doc_id = known.get(filename)
+            if doc_id is not None:
+                _, mtime, sha1 = self.docs[doc_id]
+                if mtime == os.stat(filename).st_mtime:
+                    continue
+                stamp = self.file_stamp(filename)
+                if sha1 == stamp[1]:
+                    self.docs[doc_id] = (filename,) + stamp # solo ha cambiado el mtime
+                    continue
+                del self.docs[doc_id]
+                prefix = filename + "$$$"
+                removed.update(news_id for news_id, value in self.news.items() if value.startswith(prefix))
+            pending.append(filename)
+
+        if len(pending) == 0:
+            return 0
+        self.cache.clear() # los resultados guardados ya no valen
+        self._snippet_postings = None
+        self._suggester = None
+        self._suggestions = {}
+        self.ptindex = {} # se reconstruyen al final (-P) o cuando se usen
+        self.get_vocabulary() # un indice cargado no lo guarda, se saca de las tablas
+
+        # Las tablas cargadas de disco son de solo lectura y estan comprimidas,
+        # se pasan a memoria descomprimidas para modificarlas
+        for index in (self.index, self.sindex):
+            for field in index:
+                index[field] = {term: plist.decode() for term, plist in index[field].items()}
+
+        if removed:
+            for news_id in removed:
+                del self.news[news_id]
+            for index in (self.index, self.sindex):
+                for field in index:
+                    table = index[field]
+                    for term in list(table):
+                        plist = table[term].without(removed)
+                        if len(plist) == 0:
+                            del table[term]
+                        else:
+                            table[term] = plist
+
+        last_news = self.news_id
+        print("Updating {} files...".format(len(pending)))
+        if workers > 1:
+            self.index_parallel(pending, workers)
+        else:
+            for filename in pending:
+                self.index_file(filename)
+
+        if self.stemming:
+            # Solo hay que añadir a los stems los postings nuevos, que estan al final de las listas
+            for section in self.sections:
+                tails = defaultdict(list)
+                for word, plist in self.index[section].items():
+                    if plist.ids[-1] > last_news:
+                        tails[self.stemmer.stem(word)].append(plist[bisect.bisect_right(plist.ids, last_news):])
+                stems = self.sindex[section]
+                for stem, plists in tails.items():
+                    if stem in stems:
+                        plists.append(stems[stem])
+                    stems[stem] = merge_postings(plists, self.stem_positions(section))
+
+        self.compress_index()
+        self.make_weights()
+        if self.permuterm:
+            self.make_permuterm()
+        return len(pending)
+
+
+    def compress_index(self):
+        """
+        Comprime por bloques (delta + variable-byte) todas las posting lists de self.index y self.sindex.
+        Se llama al terminar de indexar; las consultas las descomprimen al pedirlas.
+
+        Las de los terminos con df >= BITMAP_RATIO * N ademas guardan su conjunto de documentos
+        como bitmap, para que AND/OR/NOT con ellos sean operaciones de bits.
+
+        """
+        limit = max(1, int(self.news_id * self.BITMAP_RATIO))
+        for index in (self.index, self.sindex):
+            for field in index:
+                table = index[field]
+                for term in table:
+                    plist = table[term].compress()
+                    if len(plist) >= limit and not isinstance(plist, BitmapPostingList):
+                        plist = BitmapPostingList.from_ids(plist.news_ids(), plist)
+                    table[term] = plist
+
+
+    def make_weights(self):
+        """
+        NECESARIO PARA LA AMPLIACION DE RANKING
+
+        Calcula los pesos de BM25 que no dependen de la consulta: el idf de cada termino
+        (self.weight[campo][termino]), la longitud media de cada campo (self.avgdl) y la
+        puntuacion maxima de cada termino en una noticia (self.max_score, cota para WAND).
+
+        """
+        n = len(self.news)
+        for section in self.sections:
+            lengths = self.doc_len[section]
+            self.avgdl[section] = sum(lengths[news_id] for news_id in self.news) / max(n, 1)
+            weights = self.weight[section] = {}
+            bounds = self.max_score[section] = {}
+            for term, plist in self.index[section].items():
+                weights[term] = self.idf(len(plist))
+                bounds[term] = self.term_max_score(plist, section, weights[term])
+
+
+    def term_max_score(self, plist, field, idf):
+        """
+        Maxima puntuacion BM25 de un termino en las noticias de su posting list.
+        """
+        if isinstance(plist, BitmapPostingList):
+            plist = plist.payload if plist.payload is not None else plist.decode()
+        blocks = plist.blocks(False) if isinstance(plist, CompressedPostingList) else [plist]
+        lengths = self.doc_len[field]
+        k1 = self.BM25_K1
+        norm = k1 * (1 - self.BM25_B)
+        slope = k1 * self.BM25_B / max(self.avgdl.get(field, 0), 1)
+        best = 0.0
+        for block in blocks:
+            for news_id, tf in zip(block.ids, block.freqs):
+                score = tf / (tf + norm + slope * lengths[news_id])
+                if score > best:
+                    best = score
+        return idf * best * (k1 + 1)
+
+
+    def idf(self, df):
+        # idf de BM25 (siempre positivo)
+        n = len(self.news)
+        return math.log((n - df + 0.5) / (df + 0.5) + 1)
+
+
+    def file_stamp(self, filename):
+        """
+        Devuelve (mtime, sha1 del contenido) de un fichero, para detectar cambios con --update.
+
+        """
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 16), b''):
+                digest.update(block)
+        return os.stat(filename).st_mtime, digest.hexdigest()
+
+
     def index_file(self, filename):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -192,39 +500,52 @@ class SAR_Project:
         En estos casos, se recomienda crear nuevos metodos para hacer mas sencilla la implementacion
 
         input: "filename" es el nombre de un fichero en formato JSON Arrays (https://www.w3schools.com/js/js_json_arrays.asp).
-                Una vez parseado con json.load tendremos una lista de diccionarios, cada diccionario se corresponde a una noticia
+                Se parsea noticia a noticia con iter_json_array, asi la memoria depende del tamaño de una noticia
+                y no del fichero entero
 
         """
 
         with open(filename) as fh:
-            if self.multifield:
-                self.sections = ['title', 'keywords', "article", 'summary'] # si es multifield se actualizan las secciones a indexar
-
             self.doc_id += 1 # id del filename (clave)
-            self.docs[self.doc_id] = filename # el valor es la ruta
-            jlist = json.load(fh)
-            for noticia in jlist:
+            self.docs[self.doc_id] = (filename,) + self.file_stamp(filename) # el valor es la ruta, con su mtime y hash para --update
+            for noticia in iter_json_array(fh):
                 self.news_id += 1 # id de la noticia (clave)
-                self.news[self.news_id] = self.docs[self.doc_id] + "$$$" + noticia["id"] # el valor será la ruta del documento donde se encuentra y el hash propio de la noticia.
+                self.news[self.news_id] = filename + "$$$" + noticia["id"] # el valor será la ruta del documento donde se encuentra y el hash propio de la noticia.
                 for section in self.sections: # por el multifield
                     content = noticia[section] # contenido raw
-                    tokens = self.tokenize(content)
-                    aux = {}
-                    position = {}
-                    pos = 0
-                    for token in tokens:
-                        aux[token] = aux.get(token, 0) + 1 # se cuentan las ocurrencias del token
-                        self.vocabulary.append(token)
+                    if section == "article":
+                        # los offsets de los tokens del articulo se guardan para los snippets
+                        tokens, spans = tokenize_spans(content)
+                        self.store.add(self.news_id, noticia, spans)
+                    else:
+                        tokens = self.tokenize(content)
+                    self.doc_len[section].append(len(tokens)) # para la normalizacion por longitud de BM25
+                    table = self.index[section]
                     if self.positional:
-                        for token in tokens:
-                            pos+=1 # contador para saber en qué posición está cada token
-                            position[token] = position.get(token, [])
-                            position[token].append(pos) # lista de todas las posiciones del token
-                    for word in aux:
-                        self.index[section][word] = self.index[section].get(word, []) # si no existe se crea una lista
-                        self.index[section][word].append(Posting(self.news_id, aux[word], position.get(word, None))) # se crea el posting_list del token en la noticia en la sección
+                        # una sola pasada: posiciones de cada token, su frecuencia es cuantas hay
+                        position = {}
+                        for pos, token in enumerate(tokens, 1):
+                            p = position.get(token)
+                            if p is None:
+                                position[token] = [pos]
+                            else:
+                                p.append(pos)
+                        for word, p in position.items():
+                            plist = table.get(word)
+                            if plist is None: # si no existe se crea una posting list compacta
+                                plist = table[word] = PostingList()
+                            plist.append(self.news_id, len(p), p) # se añade el posting del token en la noticia en la sección
+                        self.vocabulary.update(position)
+                    else:
+                        aux = Counter(tokens) # se cuentan las ocurrencias de cada token
+                        for word, freq in aux.items():
+                            plist = table.get(word)
+                            if plist is None:
+                                plist = table[word] = PostingList()
+                            plist.append(self.news_id, freq)
+                        self.vocabulary.update(aux)
         #
-        # "jlist" es una lista con tantos elementos como noticias hay en el fichero,
+        # El fichero es una lista con tantos elementos como noticias hay en el fichero,
         # cada noticia es un diccionario con los campos:
         #      "title", "keywords", "article", "summary"
         #
@@ -236,31 +557,115 @@ class SAR_Project:
         ### COMPLETAR ###
         #################
 
-    # ALGORITMICA
-    def make_vocab(self):
-        self.vocabulary = list(set(self.vocabulary))
-        fn = open("vocabulary.txt", "w", encoding="utf-8")
-        for word in self.vocabulary:
-            fn.write(word + " ")
-        fn.close()
+    def save(self, path):
+        """
+        Guarda el indice en el directorio "path" con el formato binario de SAR_storage:
+        diccionario de terminos ordenado + fichero de postings + fichero de posiciones.
+
+        Con el indice se guardan el vocabulario y el corrector ortografico ya construido,
+        para que related() no tenga que reconstruirlo al cargar.
+
+        """
+        tables = {}
+        for kind, index in (("index", self.index), ("sindex", self.sindex)):
+            for field in index:
+                tables[(kind, field)] = index[field]
+        save_index(self, path, tables, self.TRANSIENT_STATE, {name: getattr(self, name) for name in self.COLUMNS},
+                   self.ptindex)
+        save_suggester(path, self.get_vocabulary(), TrieSuggester)
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Carga un indice guardado con "save". Las posting lists se quedan en disco (mmap)
+        y se decodifican cuando get_posting las pide.
+
+        Los indices antiguos (el objeto entero en un fichero pickle) no se pueden cargar: sus
+        posting lists son listas de Posting, hay que volver a crearlos con SAR_Indexer.py.
+
+        return: objeto SAR_Project
+        """
+        if os.path.isfile(path):
+            raise Exception("load: {} es un indice en un formato antiguo (pickle), vuelve a crearlo con SAR_Indexer.py".format(path))
+        state, files, store = load_index(path)
+        project = cls.__new__(cls)
+        project.__dict__.update(state)
+        project.store = store
+        project.cache = QueryCache(cls.QUERY_CACHE_SIZE)
+        project.path = path
+        project._suggester = None
+        project._suggestions = {}
+        project._postings = None
+        project._snippet_postings = None
+        project.vocabulary = None
+        project.index = {}
+        project.sindex = {}
+        for name in files.meta["columns"]:
+            setattr(project, name, {})
+        for kind, field in files.meta["tables"]:
+            table = getattr(project, kind)[field] = files.table((kind, field))
+            for name in table.columns:
+                getattr(project, name)[field] = table.column(name)
+        project.ptindex = {field: files.permuterm(field) for field in files.meta["permuterms"]}
+        return project
+
+
+    def get_vocabulary(self):
+        """
+        Devuelve el vocabulario. Un indice cargado de disco no lo guarda (los terminos ya estan
+        en el lexicon), se saca de las tablas de las secciones indexadas la primera vez.
+        """
+        if self.vocabulary is None:
+            self.vocabulary = set().union(*(self.index[section] for section in self.sections))
+        return self.vocabulary
+
+
+    def get_suggester(self):
+        """
+        Devuelve el corrector ortografico: el guardado con el indice, que se carga la primera vez
+        que se usa, o uno construido con el vocabulario si el indice no lo tiene.
+        """
+        if self._suggester is None:
+            if self.path is not None:
+                self._suggester = load_suggester(self.path)
+            if self._suggester is None:
+                self._suggester = TrieSuggester(self.get_vocabulary())
+        return self._suggester
+
+
+    def in_vocabulary(self, term):
+        # busqueda en los diccionarios de terminos, sin recorrer self.vocabulary
+        return any(term in self.index[section] for section in self.sections)
+
+
+    def df(self, term):
+        """
+        Numero de noticias que contienen "term" en alguno de los campos indexados (sin decodificar las listas).
+        """
+        return sum(len(self.index[section].get(term, PostingList())) for section in self.sections)
 
     def tokenize(self, text):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
         Tokeniza la cadena "texto" eliminando simbolos no alfanumericos y dividientola por espacios.
-        Puedes utilizar la expresion regular 'self.tokenizer'.
 
         params: 'text': texto a tokenizar
 
         return: lista de tokens
 
+        Se buscan directamente las secuencias de caracteres alfanumericos (la expresion regular
+        _WORD, con findall) en vez de sustituir los demas por espacios y partir. Se buscan en el
+        texto original y se pasa a minusculas cada token, igual que en tokenize_spans: algunas
+        letras cambian de longitud al pasarlas a minusculas ("İ" -> "i" + punto combinado) y
+        partirian el token.
         """
-        return self.tokenizer.sub(' ', text.lower()).split()
+        return [token.lower() for token in _WORD.findall(text)]
 
 
 
-    def make_stemming(self):
+    def make_stemming(self, workers=1):
         """
         NECESARIO PARA LA AMPLIACION DE STEMMING.
 
@@ -268,18 +673,36 @@ class SAR_Project:
 
         self.stemmer.stem(token) devuelve el stem del token
 
+        Las palabras se agrupan por stem y la lista de cada stem se construye con un solo
+        merge de k vias de las listas de sus palabras (merge_postings), que guarda solo
+        news_id y frecuencias, y posiciones si hacen falta (stem_positions). Con "workers" > 1
+        los stems de cada campo se calculan en procesos distintos.
+
         """
+        words = {section: list(self.index[section]) for section in self.sections}
+        if workers > 1 and len(self.sections) > 1:
+            with multiprocessing.Pool(min(workers, len(self.sections))) as pool:
+                stems = dict(zip(self.sections, pool.map(_stem_words, [words[s] for s in self.sections])))
+        else:
+            stems = {section: _stem_words(words[section]) for section in self.sections}
+
         for section in self.sections:
-            for word in self.index[section]: # recorre el indice normal en busca de palabras
-                stem = self.stemmer.stem(word) # crea un stem de la palabra
-                self.sindex[section][stem] = self.sindex[section].get(stem, []) # si no existe el stem se crea una lista
-                self.sindex[section][stem] = self.or_posting(self.sindex[section][stem], self.index[section][word]) # añade las posting list de word al stem de esa word
-                # La llamada a or_posting es porque necesitamos ordenar las listas para las consultas y or posting lo hace genial.
+            groups = defaultdict(list) # stem -> posting lists de las palabras con ese stem
+            table = self.index[section]
+            for word, stem in zip(words[section], stems[section]):
+                groups[stem].append(table[word])
+            positions = self.stem_positions(section)
+            self.sindex[section] = {stem: merge_postings(plists, positions) for stem, plists in groups.items()}
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
 
+    def stem_positions(self, section):
+        # en un indice posicional los stems de article guardan las posiciones, de ahi salen
+        # los snippets con stemming (snippet_hits)
+        return self.positional and section == 'article'
+
     def make_permuterm(self):
         """
         NECESARIO PARA LA AMPLIACION DE PERMUTERM
@@ -287,10 +710,8 @@ class SAR_Project:
         Crea el indice permuterm (self.ptindex) para los terminos de todos los indices.
 
         """
-        pass
-        ####################################################
-        ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
-        ####################################################
+        for section in self.sections:
+            self.ptindex[section] = PermutermIndex(self.index[section])
 
 
 
@@ -315,20 +736,32 @@ class SAR_Project:
         for i in self.sections:
             print("  # of tokens in {}: {}".format(i, len(self.index[i])))
         print("----------------------------------------")
+        print("POSTINGS:")
+        for i in self.sections:
+            npostings = sum(len(p) for p in self.index[i].values())
+            nbytes = sum(p.nbytes() for p in self.index[i].values())
+            raw = sum(p.compress().raw_nbytes() for p in self.index[i].values())
+            nbitmaps = sum(1 for p in self.index[i].values() if isinstance(p, BitmapPostingList))
+            print("  # of postings in {}: {} ({:.2f} bytes/posting, compression ratio {:.2f}, {} bitmap terms)".format(
+                i, npostings, nbytes / max(npostings, 1), raw / max(nbytes, 1), nbitmaps))
+        print("----------------------------------------")
         if(self.stemming):
             print("STEMS:")
             for i in self.sections:
                 print("  # of stems in {}: {}".format(i, len(self.sindex[i]))) # aún falta hacer cosas
             print("----------------------------------------")
+        if(self.permuterm):
+            print("PERMUTERMS:")
+            for i in self.sections:
+                pt = self.ptindex[i]
+                print("  # of permuterms in {}: {} ({:.2f} bytes/permuterm)".format(i, len(pt), pt.nbytes() / max(len(pt), 1)))
+            print("----------------------------------------")
         if(self.positional):
             print("Positional queries are allowed")
         else:
             print("Positional queries are NOT allowed")
         print("========================================")
 
-        ## Como los permuterm no existen en nuestro diseño
-        ## no me voy a molestar en implementarlo
-
 
     ###################################
     ###                             ###
@@ -349,151 +782,198 @@ class SAR_Project:
                 "prev": incluido por si se quiere hacer una version recursiva. No es necesario utilizarlo.
 
 
-        return: posting list con el resultado de la query
+        return: (posting list con el resultado de la query, lista de terminos)
+                Si el resultado es una negacion es una NotPostingList sin materializar:
+                len() ya da el numero de resultados y decode() construye la lista.
 
         """
 
         if query is None or len(query) == 0:
-            return []
-
-        class State(Enum):
-            POST = auto()   #Representa una posting list de un término
-            OP = auto()     #Representa una operación
-            PAR = auto()    #Representa un paréntesis
-
-        #shlex mantiene el texto entre comillas con posix=False
-        #y separa los paréntesis en tokens únicos con punctuation_chars=True
-        #técnicamente con punctuation_chars separa los caracteres ();<>|&
-        #también separa con los dos puntos (:) lo cual es raro pero funciona así
-
-        #Haremos una primera pasada para hacer las queries al sistema de recuperación.
-        #Después las uniremos con AND, OR, NOT y los paréntesis
-
-        #Si aparece un token después de un token hay que hacer un and entre los dos.
-        #En ese caso añadiremos un AND a la pila de objetos que quedará como resultado
-        token_after_token = False
-        # print("query:{}".format(query))
-        tokens = shlex.shlex(instream=query, posix=False, punctuation_chars=True)
-        tokens.wordchars += 'áéíóúüÁÉÍÓÚÜñ'
-        elements=[]
-        t = tokens.get_token()
-
-        terms=[]
-
-        while (t != ''):
-            # print("token:{}".format(t))
-            if (t == 'AND') or (t == 'OR') or (t == 'NOT'):
-                elements.append((State.OP, t))
-                t = tokens.get_token()
-                token_after_token = False
-            #Pueden haber varios parentesis en un token
-            elif (t[0] == '(') or (t[0] == ')'):
-                for ch in t:
-                    elements.append((State.PAR, ch))
-
-                t = tokens.get_token()
-                token_after_token = False
-
-            else: #token
-
-                #If there were two consecutive tokens, we need to make an AND between them.
-                #We push an AND onto the stack
-                if token_after_token:
-                    elements.append((State.OP, "AND"))
-
-                t0 = t
-                t = tokens.get_token() #fortunately, if it's eof, shlex returns '' and we can work with that
-
-                if (t == ':'):  #it's a multifield term and t0 is the field
-                    t = tokens.get_token() #t is now the token to search
-                    elements.append((State.POST, self.get_posting(t, field=t0)))
-                    if (t[0]=='"'):
-                        terms.append(t[1:-1])
-                    else:
-                        terms.append(t)
-                    t = tokens.get_token()
-                else:   #no multifield
-                    elements.append((State.POST, self.get_posting(t0)))
-                    if (t0[0]=='"'):
-                        terms.append(t0[1:-1])
-                    else:
-                        terms.append(t0)
-                    #t is the next token
-
-                token_after_token = True
-
-        #Ahora elements es una lista (pila) de tuplas (State, object) con la que podemos organizar un analizador
-        #léxico tipo autómata a pila (utilizamos la pila para los paréntesis).
-
-        stack=[]
-        funcdict = {
-            "AND":self.and_posting,
-            "OR":self.or_posting,
-            "AND NOT":self.minus_posting
-        } #Diccionario de operaciones binarias :)
-
-        ornot=False
-
-        for obj in elements:
-            computed=False
-            while not(computed):
-                #De normal una iteración bastará para procesar un elemento de la query
-                computed=True
-                state=None
-                if (len(stack) > 0):
-                    state = stack[-1][0]
-
-                if (state == None) or (state == State.PAR):
-                    #Estamos al principio de una consulta o con un paréntesis izquierdo. Añadimos lo que haya al stack
-                    stack.append(obj)
-
-                elif (state == State.POST):
-                    #Después de un posting puede haber una operación o un paréntesis de cierre:
-                    if (obj[0] == State.OP):
-                        stack.append(obj)
-                    elif (obj[0] == State.PAR):
-                        #Hemos completado un paréntesis. Tenemos que eliminar los paréntesis, dejar el contenido en el
-                        #nivel inferior, y volver a computar este término.
-                        obj = stack.pop() #Obj es la posting list que hay dentro del paréntesis
-                        stack.pop() #Eliminamos el paréntesis abierto
-                        #Y volvemos a operar con el posting del paréntesis
-                        computed=False
-
-                else: #OP
-                    #Después de una operación puede haber un posting (realizar operación), un NOT (para el AND/OR NOT) o un paréntesis (posponer la operación)
-                    if (obj[0] == State.PAR):
-                        stack.append(obj)
-                    elif (obj[0] == State.OP):
-                        #Puede ser AND NOT u OR NOT.
-                        if (stack[-1][1] == "AND"):
-                            stack.pop()
-                            stack.append((state,"AND NOT"))
-                        elif (stack[-1][1] == "OR"):
-                            stack.append(obj)
-                            ornot=True
-                    elif (obj[0] == State.POST):
-                        #Operar según la operación
-                        op = stack.pop()[1]
-                        if (op == "NOT"):
-                            post = self.reverse_posting(obj[1])
-                            if ornot:
-                                obj = (State.POST, post)
-                                #Dejamos que vuelva a iterar para que compute el OR,
-                                #que está debajo en el stack
-                                computed=False
-                            else:
-                                stack.append((State.POST, post))
-                        else:
-                            t1 = stack.pop()[1] #Posting de detrás de la operación
-                            post = funcdict[op](t1, obj[1]) #Realizar la operación que toca
-                            stack.append((State.POST, post)) #Dejamos el resultado en el stack
-                            computed = True
+            return PostingList(), []
+
+        #La query se parsea a un árbol (SAR_query), se reordena según el número estimado de
+        #resultados de cada rama y se evalúa con evaluate
+        node, terms = parse_query(query)
+        if node is None:
+            return PostingList(), terms
+        node = plan(node, self.estimate_node, len(self.news))
+        result = self.evaluate(node)
+        if self.explain:
+            print("Plan for: {}".format(query))
+            print("\n".join(explain(node)))
+        return result, terms
+
+
+    def solve_batch(self, queries, workers=1):
+        """
+        Resuelve una lista de queries.
+
+        Se parsean todas primero y se evaluan en orden compartiendo el trabajo: cada posting
+        list (campo, termino, modo de stemming) se pide una vez y las subconsultas repetidas
+        salen de self.cache, que se agranda durante el lote para que quepan todas.
 
-        #Ahora deberíamos tener en el stack un solo posting con todo.
-        return stack[0][1], terms
+        Con "workers" > 1 las queries se reparten entre procesos, que cargan el indice de
+        self.path (solo para indices cargados con load).
 
+        param:  "queries": lista de cadenas
+                "workers": numero de procesos
 
-    def get_posting(self, term, field='article'):
+        return: lista de (query, posting list con el resultado, segundos) en el orden de "queries"
+        """
+        if workers > 1 and len(queries) > 1:
+            if self.path is None:
+                raise Exception("solve_batch: para usar varios procesos el indice debe estar guardado")
+            size = -(-len(queries) // workers)
+            chunks = [queries[i:i + size] for i in range(0, len(queries), size)]
+            config = (self.path, self.use_stemming)
+            res = []
+            with multiprocessing.Pool(workers, initializer=_init_batch_worker, initargs=(config,)) as pool:
+                for part in pool.map(_solve_batch_chunk, chunks):
+                    res.extend(part)
+            return res
+
+        parsed = [(query, parse_query(query)[0] if query else None) for query in queries]
+        size = self.cache.size
+        self.cache.resize(max(size, sum(count_nodes(node) for _, node in parsed)))
+        self._postings = {}
+        res = []
+        try:
+            for query, node in parsed:
+                t0 = time.perf_counter()
+                if node is None:
+                    result = PostingList()
+                else:
+                    result = self.evaluate(plan(node, self.estimate_node, len(self.news)))
+                res.append((query, result, time.perf_counter() - t0))
+        finally:
+            self._postings = None
+            self.cache.resize(size)
+        return res
+
+
+    def estimate(self, term, field='article'):
+        """
+        Devuelve el numero de noticias que contienen "term" (la longitud de su posting list),
+        sin decodificarla. Para un termino posicional se usa el minimo de sus terminos.
+
+        param:  "term": termino de la query (puede ir entre comillas)
+                "field": campo del termino
+
+        return: numero estimado de resultados
+        """
+        if term[0] != '"' and has_wildcard(term):
+            return self.estimate_wildcard(self.expand_wildcard(term, field), field)
+        term_t = self.tokenize(term)
+        if len(term_t) == 0:
+            return 0
+        if term[0] == '"':
+            return min(len(self.index[field].get(t, PostingList())) for t in term_t)
+        if self.use_stemming:
+            return len(self.sindex[field].get(self.stemmer.stem(term_t[0]), PostingList()))
+        return len(self.index[field].get(term_t[0], PostingList()))
+
+
+    def estimate_node(self, node):
+        """
+        "estimate" de un nodo TERM para plan. Un comodin se expande aqui y sus terminos se
+        guardan en "node.terms" para que evaluate no lo vuelva a expandir.
+        """
+        if node.term[0] != '"' and has_wildcard(node.term):
+            node.terms = self.expand_wildcard(node.term, node.field)
+            return self.estimate_wildcard(node.terms, node.field)
+        return self.estimate(node.term, node.field)
+
+
+    def estimate_wildcard(self, terms, field='article'):
+        table = self.index[field]
+        return min(len(self.news), sum(len(table[t]) for t in terms))
+
+
+    def evaluate(self, node):
+        """
+        Evalua un nodo del plan de la query y apunta en "node.actual" el tamaño del resultado.
+
+        Los AND empiezan por el operando mas pequeño, restan los operandos negados con
+        minus_posting y dejan de evaluar operandos en cuanto el resultado es vacio.
+
+        Los resultados de los operadores y de los terminos posicionales se guardan en
+        self.cache con la clave canonica del nodo y el modo de stemming.
+
+        param:  "node": nodo de SAR_query.plan
+
+        return: posting list con el resultado
+        """
+        key = None
+        if node.kind != TERM or node.term[0] == '"':
+            key = (self.use_stemming, node.key or canonical(node, self.normalize))
+            res = self.cache.get(key)
+            if res is not None:
+                node.actual = len(res)
+                node.cached = True
+                return res
+
+        if node.kind == TERM:
+            if self._postings is not None:
+                # solve_batch: cada posting list se pide una sola vez para todas las queries
+                tkey = (node.field, self.normalize(node.term, node.field), self.use_stemming)
+                res = self._postings.get(tkey)
+                if res is None:
+                    res = self._postings[tkey] = self.get_posting(node.term, field=node.field, terms=node.terms)
+            else:
+                res = self.get_posting(node.term, field=node.field, terms=node.terms)
+
+        elif node.kind == NOT:
+            res = self.reverse_posting(self.evaluate(node.children[0]))
+
+        elif node.kind == AND:
+            positive = [c for c in node.children if c.kind != NOT]
+            negative = [c for c in node.children if c.kind == NOT]
+            if positive:
+                res = self.evaluate(positive[0])
+                positive = positive[1:]
+            else:
+                res = self.evaluate(negative[0])
+                negative = negative[1:]
+            for child in positive:
+                if len(res) == 0:
+                    break
+                res = self.and_posting(res, self.evaluate(child))
+            for child in negative:
+                if len(res) == 0:
+                    break
+                res = self.minus_posting(res, self.evaluate(child.children[0]))
+                child.actual = len(self.news) - child.children[0].actual
+
+        else: #OR
+            res = self.evaluate(node.children[0])
+            for child in node.children[1:]:
+                res = self.or_posting(res, self.evaluate(child))
+
+        node.actual = len(res)
+        if key is not None:
+            self.cache.put(key, res)
+        return res
+
+
+    def normalize(self, term, field='article'):
+        """
+        Forma normalizada de un termino de la query para la cache: tokenizado y, si se usa
+        stemming, su stem (asi dos palabras con el mismo stem comparten resultados).
+
+        """
+        if term[:1] == '"':
+            return '"' + " ".join(self.tokenize(term)) + '"'
+        if has_wildcard(term):
+            return term.lower() # los comodines no usan stemming
+        term_t = self.tokenize(term)
+        if len(term_t) == 0:
+            return ""
+        if self.use_stemming:
+            return self.stemmer.stem(term_t[0])
+        return term_t[0]
+
+
+    def get_posting(self, term, field='article', terms=None):
         """
         NECESARIO PARA TODAS LAS VERSIONES
         Luego las uniremos con la consulta
@@ -506,6 +986,7 @@ class SAR_Project:
 
         param:  "term": termino del que se debe recuperar la posting list.
                 "field": campo sobre el que se debe recuperar la posting list, solo necesario se se hace la ampliacion de multiples indices
+                "terms": terminos de un comodin ya expandidos (Node.terms), si no se expande aqui
 
         return: posting list
 
@@ -513,6 +994,8 @@ class SAR_Project:
         positional=False
         if (term[0]=='"'):
             positional=True
+        elif has_wildcard(term):
+            return self.get_permuterm(term, field, terms)
         term_t = self.tokenize(term)
         # print("term_tokenized: {}".format(term_t))
         #obtenemos el/los términos en formato token
@@ -522,7 +1005,7 @@ class SAR_Project:
             if(self.use_stemming):
                 return self.get_stemming(term_t[0],field)
             else:
-                return self.index[field].get(term_t[0], [])
+                return self.index[field].get(term_t[0], PostingList())
 
 
         ########################################
@@ -545,9 +1028,9 @@ class SAR_Project:
         """
         #Max: Este es el algoritmo visto en teoría de intersección posicional con k=1 (términos consecutivos)
         #Para las consultas posicionales ignoramos el stemming
-        p1 = self.index[field].get(terms[0], [])
+        p1 = self.index[field].get(terms[0], PostingList()).decode()
         for i in range(1,len(terms)):
-            p1 = self.interseccion_posicional(p1,self.index[field].get(terms[i], []))
+            p1 = self.interseccion_posicional(p1,self.index[field].get(terms[i], PostingList()).decode())
         return p1
 
 
@@ -556,22 +1039,23 @@ class SAR_Project:
         #p1, p2: posting lists, posición en p1 debe ser menor que la de p2
         #recupera una posting list con los valores Posting de términos consecutivos
         #p1, p2: posting lists, posición en p1 debe ser menor que la de p2
-        res = []
+        res = PostingList()
+        ids1 = p1.ids
+        ids2 = p2.ids
         i=0
         j=0
         #i,j: contadores de postings en posting list
         x=0
         y=0
         #x,y: contadores de posiciones dentro de un posting
-        while (i < len(p1) and j < len(p2)): # mientras no se hayan explorado todos los posting de alguna de las dos listas
-            if(p1[i].news_id == p2[j].news_id): # se comprueba que los news_id de sendos posting son iguales
+        while (i < len(ids1) and j < len(ids2)): # mientras no se hayan explorado todos los posting de alguna de las dos listas
+            if(ids1[i] == ids2[j]): # se comprueba que los news_id de sendos posting son iguales
                 x=0
                 y=0
                 positions = [] #lista donde irán las posiciones consecutivas de p1 y p2 que se encuentren
-                pos1 = p1[i].pos #pos1 = lista de posiciones de p1[1]
-                pos2 = p2[j].pos #pos2 = lista de posiciones de p2[2]
+                pos1 = p1.get_pos(i) #pos1 = posiciones del posting i de p1
+                pos2 = p2.get_pos(j) #pos2 = posiciones del posting j de p2
                 while ((x < len(pos1)) and (y < len(pos2))): # se detiene solo si x excede la cantidad de pos de p1
-                    #print("dentro de p2, analizando posición {}".format(y))
                         if(pos2[y]-pos1[x] == 1): # si pos2 es inmediatamente posterior a pos1:
                             positions.append(pos2[y]) # en ese caso se añade la posición posterior a la lista de posiciones
                             x=x+1 #una vez encontradas las posiciones contiguas avanzamos
@@ -582,11 +1066,10 @@ class SAR_Project:
                         else:                   # else solo si pos1 es mayor que pos2, aumentamos pos2 y probar otra vez
                             y=y+1
                 if(len(positions) > 0):  # si se han encontrado dos posiciones consecutivas una o más veces
-                    elem = Posting(p1[i].news_id,None,positions) # crear una posting list que tenga el id del doc y las posiciones encontradas
-                    res.append(elem) #añadir esa posting list al resultado final
+                    res.append(ids1[i], 1, positions) # se añade un posting con el id del doc y las posiciones encontradas
                 i = i+1 # ya hemos comprobado las posiciones de ese doc. en ambas posting lists pasamos al siguiente doc.
                 j = j+1
-            elif(p1[i].news_id < p2[j].news_id): #ante docs distintos aumentamos el menor para ver si coinciden.
+            elif(ids1[i] < ids2[j]): #ante docs distintos aumentamos el menor para ver si coinciden.
                 i = i+1
             else:
                 j = j+1
@@ -606,14 +1089,14 @@ class SAR_Project:
         """
 
         stem = self.stemmer.stem(term)
-        return self.sindex[field].get(stem, [])
+        return self.sindex[field].get(stem, PostingList())
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
 
 
-    def get_permuterm(self, term, field='article'):
+    def get_permuterm(self, term, field='article', terms=None):
         """
         NECESARIO PARA LA AMPLIACION DE PERMUTERM
 
@@ -621,14 +1104,43 @@ class SAR_Project:
 
         param:  "term": termino para recuperar la posting list, "term" incluye un comodin (* o ?).
                 "field": campo sobre el que se debe recuperar la posting list, solo necesario se se hace la ampliacion de multiples indices
+                "terms": resultado de expand_wildcard si ya se ha calculado (al planificar la query)
 
         return: posting list
 
+        El resultado es la union (merge de k vias) de las listas de los terminos que encajan,
+        sin posiciones. Los comodines no usan stemming.
+
         """
+        if terms is None:
+            terms = self.expand_wildcard(term, field)
+        table = self.index[field]
+        return merge_postings([table[t] for t in terms])
 
-        ##################################################
-        ## COMPLETAR PARA FUNCIONALIDAD EXTRA PERMUTERM ##
-        ##################################################
+
+    def expand_wildcard(self, term, field='article'):
+        """
+        Devuelve los terminos del campo "field" que encajan con "term" (con * o ?), como mucho
+        los MAX_WILDCARD_TERMS mas frecuentes.
+
+        Si el indice se creo sin permuterm (-P), el del campo se construye la primera vez que se usa.
+        Un prefijo ("casa*") en un indice cargado de disco no lo necesita: sus terminos son un
+        rango de ids del lexicon (DiskTable.prefix).
+        """
+        pt = self.ptindex.get(field)
+        table = self.index[field]
+        if pt is None and hasattr(table, "prefix") and term[-1] == "*" and not has_wildcard(term[:-1]):
+            terms = list(table.prefix(term[:-1].lower()))
+        else:
+            if pt is None:
+                # en una tabla de disco los terminos se leen del lexicon, sin copiarlos
+                lexicon = getattr(table, "lexicon", None)
+                pt = PermutermIndex(table) if lexicon is None else PermutermIndex(lexicon, ids=table.ids)
+                self.ptindex[field] = pt
+            terms = pt.expand(term.lower())
+        if len(terms) > self.MAX_WILDCARD_TERMS:
+            terms = sorted(heapq.nlargest(self.MAX_WILDCARD_TERMS, terms, key=lambda t: len(table[t])))
+        return terms
 
 
 
@@ -649,71 +1161,92 @@ class SAR_Project:
         """
 
         """
-        El objetivo es encontrar todas las noticias y
-        devolverlas en formato posting list. Realmente esto
-        lo podemos hacer si iteramos por todo el diccionario
-        de noticias y para cada una creamos un objeto posting. Perdemos la información posicional... pero
-        no vamos a tener una consulta como
-        "valencia AND NOT playa", así que no importa
+        El complemento no se construye: se devuelve una NotPostingList que and_posting,
+        or_posting y minus_posting combinan simbolicamente. Solo si la consulta acaba siendo
+        una negacion pura se materializa (decode) recorriendo self.news, y para contar
+        resultados basta con N - |p|.
         """
-        res = []
-        #IMPORTANTE: p y news están ordenados
-        i=0
-        j = 0   #El índice de la noticia que queremos omitir
-        #Se puede hacer en tiempo lineal con la talla de news
-        keys = list(self.news.keys())
-        if (len(p)>0):
-            for i in range(0,len(keys)):
-                #p[j] es un objeto de tipo Posting
-                if (keys[i] != p[j].news_id):
-                    #Añadimos un posting correspondiente a la noticia (perdemos frequency y positional pero no importa)
-                    res.append(Posting(keys[i]))
-                else:
-                    j+=1
-                    if (j == len(p)):
-                        i+=1
-                        break #Todas las demás noticias no están en p y deben ser añadidas
+        if isinstance(p, NotPostingList):
+            return p.plist # NOT NOT p
+        if isinstance(p, BitmapPostingList):
+            return BitmapPostingList(self.universe_bits() & ~p.bits) # el complemento de un bitmap es inmediato
+        return NotPostingList(p, self.news.keys())
 
-        for k in range(i,len(keys)):
-            res.append(Posting(keys[k]))
 
-        return res
+    def universe_bits(self):
+        """
+        Bitmap (entero) con todas las noticias de la coleccion, para complementar bitmaps.
+        Se calcula una vez y se recalcula si cambian las noticias (--update).
+
+        """
+        key = (len(self.news), self.news_id)
+        cached = getattr(self, '_universe', None)
+        if cached is None or cached[0] != key:
+            cached = self._universe = (key, BitmapPostingList.from_ids(array('I', self.news.keys())).bits)
+        return cached[1]
 
 
 
-    #Precondición: p1 y p2 son listas de postings:
-    #[Posting]
+    #Precondición: p1 y p2 son posting lists (PostingList o CompressedPostingList) ordenadas por news_id
     def and_posting(self, p1, p2):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
         Calcula el AND de dos posting list de forma EFICIENTE
 
+        Se recorre la lista mas corta y en la larga se salta con un PostingCursor
+        (skip pointers por bloque + galloping), asi el coste es O(corta * log larga).
+
         param:  "p1", "p2": posting lists sobre las que calcular
 
 
-        return: posting list con los newid incluidos en p1 y p2
+        return: posting list con los newid incluidos en p1 y p2 (con los postings de p1)
 
 
         """
-        res = []
-        i = 0   #Indice de p1
-        j = 0   #Indice de p2
+        #Complementos (NOT) sin materializar
+        not1 = isinstance(p1, NotPostingList)
+        not2 = isinstance(p2, NotPostingList)
+        if not1 and not2:
+            return self.reverse_posting(self.or_posting(p1.plist, p2.plist)) # NOT a AND NOT b = NOT (a OR b)
+        if not2:
+            return self.minus_posting(p1, p2.plist) # a AND NOT b = a - b
+        if not1:
+            return self.minus_posting(p2, p1.plist)
+
+        res = PostingList()
         if (len(p1) == 0 or len(p2) == 0):
             return res
-        #Tenemos un elemento en p1 y p2. Comprobamos tipo,
-        #solo por seguridad
-        if not (isinstance(p1[i], Posting)):
-            raise Exception("and_posting: El tipo de la posting list no es [Posting]")
-        while (i < len(p1) and j < len(p2)):
-            if (p1[i].news_id == p2[j].news_id):
-                res.append(p1[i])
-                i+=1
-                j+=1
-            elif (p1[i].news_id < p2[j].news_id):
-                i+=1
-            else:
-                j+=1
+        #Comprobamos tipo, solo por seguridad
+        if not (isinstance(p1, POSTING_TYPES) and isinstance(p2, POSTING_TYPES)):
+            raise Exception("and_posting: El tipo de la posting list no es PostingList")
+        #Bitmaps: AND de bits o filtrar la otra lista con el bitmap
+        bit1 = isinstance(p1, BitmapPostingList)
+        bit2 = isinstance(p2, BitmapPostingList)
+        if bit1 and bit2:
+            return BitmapPostingList(p1.bits & p2.bits)
+        if bit2:
+            return p2.filter(p1.decode())
+        if bit1:
+            return p1.filter(p2.decode())
+        if len(p1) <= len(p2):
+            p1 = p1.decode()
+            cursor = PostingCursor(p2)
+            for i, x in enumerate(p1.ids):
+                y = cursor.next_geq(x)
+                if y is None:
+                    break
+                if y == x:
+                    res.append_from(p1, i)
+        else:
+            #El resultado lleva los postings de p1, el cursor los decodifica enteros
+            cursor = PostingCursor(p1, full=True)
+            for x in p2.news_ids():
+                y = cursor.next_geq(x)
+                if y is None:
+                    break
+                if y == x:
+                    res.append_from(cursor.chunk, cursor.i)
 
         return res
 
@@ -725,45 +1258,61 @@ class SAR_Project:
 
         Calcula el OR de dos posting list de forma EFICIENTE
 
+        Se recorre la lista mas corta y los tramos de la larga que quedan entre sus
+        elementos (localizados con galloping) se copian de golpe.
+
         param:  "p1", "p2": posting lists sobre las que calcular
 
 
         return: posting list con los newid incluidos de p1 o p2
 
         """
-        res = []
-        i = 0   #Indice de p1
-        j = 0   #Indice de p2
+        #Complementos (NOT) sin materializar
+        not1 = isinstance(p1, NotPostingList)
+        not2 = isinstance(p2, NotPostingList)
+        if not1 and not2:
+            return self.reverse_posting(self.and_posting(p1.plist, p2.plist)) # NOT a OR NOT b = NOT (a AND b)
+        if not2:
+            return self.reverse_posting(self.minus_posting(p2.plist, p1)) # a OR NOT b = NOT (b - a)
+        if not1:
+            return self.reverse_posting(self.minus_posting(p1.plist, p2))
+
         if (len(p1) == 0):
-            return p2
+            return p2.decode()
         if (len(p2) == 0):
-            return p1
-        #Tenemos un elemento en p1 y p2. Comprobamos tipo,
-        #solo por seguridad
-        if not (isinstance(p1[i], Posting)):
-            raise Exception("or_posting: El tipo de la posting list no es [Posting]")
-        while (i < len(p1) and j < len(p2)):
-            if (p1[i].news_id == p2[j].news_id):
-                res.append(p1[i])
-                i+=1
-                j+=1
-            elif (p1[i].news_id < p2[j].news_id):
-                res.append(p1[i])
-                i+=1
+            return p1.decode()
+        #Comprobamos tipo, solo por seguridad
+        if not (isinstance(p1, POSTING_TYPES) and isinstance(p2, POSTING_TYPES)):
+            raise Exception("or_posting: El tipo de la posting list no es PostingList")
+        #Si alguna es un bitmap el resultado es el OR de bits
+        if isinstance(p1, BitmapPostingList) or isinstance(p2, BitmapPostingList):
+            return BitmapPostingList(BitmapPostingList.bits_of(p1) | BitmapPostingList.bits_of(p2))
+        p1 = p1.decode()
+        p2 = p2.decode()
+        res = PostingList()
+        #a es la lista larga y b la corta. Si un newid esta en las dos nos quedamos con el posting de p1
+        a, b = (p1, p2) if len(p1) >= len(p2) else (p2, p1)
+        ids_a = a.ids
+        start = 0
+        for j, x in enumerate(b.ids):
+            k = gallop(ids_a, x, start)
+            res.extend_from(a, start, k)
+            if k < len(ids_a) and ids_a[k] == x:
+                if a is p1:
+                    res.append_from(a, k)
+                else:
+                    res.append_from(b, j)
+                start = k + 1
             else:
-                res.append(p2[j])
-                j+=1
-        if i < len(p1):
-            res+= p1[i:]
-        if j < len(p2):
-            res+=p2[j:]
+                res.append_from(b, j)
+                start = k
+        res.extend_from(a, start)
         return res
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
-    #Precondición: p1 y p2 son listas de postings:
-    #[Posting]
+    #Precondición: p1 y p2 son posting lists (PostingList o CompressedPostingList) ordenadas por news_id
     def minus_posting(self, p1, p2):
         """
         OPCIONAL PARA TODAS LAS VERSIONES
@@ -771,43 +1320,62 @@ class SAR_Project:
         Calcula el except de dos posting list de forma EFICIENTE.
         Esta funcion se propone por si os es util, no es necesario utilizarla.
 
+        Si p1 es la corta se busca cada elemento en p2 con un PostingCursor; si no,
+        se localizan los elementos de p2 en p1 con galloping y se copian los tramos entre ellos.
+
         param:  "p1", "p2": posting lists sobre las que calcular
 
 
         return: posting list con los newid incluidos de p1 y no en p2
 
         """
-        res = []
-        i = 0   #Indice de p1
-        j = 0   #Indice de p2
+        #Complementos (NOT) sin materializar
+        if isinstance(p2, NotPostingList):
+            return self.and_posting(p1, p2.plist) # a - NOT b = a AND b
+        if isinstance(p1, NotPostingList):
+            return self.reverse_posting(self.or_posting(p1.plist, p2)) # NOT a - b = NOT (a OR b)
+
+        res = PostingList()
         if (len(p1) == 0):
             return res
         if (len(p2) == 0):
-            return p1
-
-        #Tenemos un elemento en p1 y p2. Comprobamos tipo,
-        #solo por seguridad
-        if not (isinstance(p1[i], Posting)):
-            raise Exception("minus_posting: El tipo de la posting list no es [Posting]")
-        while (i < len(p1) and j < len(p2)):
-            if (p1[i].news_id == p2[j].news_id):
-                i+=1
-                j+=1
-            elif (p1[i].news_id < p2[j].news_id):
-                res.append(p1[i])
-                i+=1
-            else:
-                j+=1
-
-        while (i < len(p1)):
-            res.append(p1[i])
-            i+=1
+            return p1.decode()
+
+        #Comprobamos tipo, solo por seguridad
+        if not (isinstance(p1, POSTING_TYPES) and isinstance(p2, POSTING_TYPES)):
+            raise Exception("minus_posting: El tipo de la posting list no es PostingList")
+        #Bitmaps: p1 & ~p2 o filtrar p1 con el bitmap
+        if isinstance(p1, BitmapPostingList):
+            return BitmapPostingList(p1.bits & ~BitmapPostingList.bits_of(p2))
+        if isinstance(p2, BitmapPostingList):
+            return p2.filter(p1.decode(), keep=False)
+        p1 = p1.decode()
+        ids1 = p1.ids
+        if len(p1) <= len(p2):
+            cursor = PostingCursor(p2)
+            for i, x in enumerate(ids1):
+                y = cursor.next_geq(x)
+                if y is None:
+                    res.extend_from(p1, i)
+                    break
+                if y != x:
+                    res.append_from(p1, i)
+        else:
+            start = 0
+            for x in p2.news_ids():
+                k = gallop(ids1, x, start)
+                if k == len(ids1):
+                    break
+                if ids1[k] == x:
+                    res.extend_from(p1, start, k)
+                    start = k + 1
+            res.extend_from(p1, start)
 
         return res
 
 
 
-    def related(self, query, terms):
+    def related(self, query, terms, verbose=True):
         """
         ALGORITMICA
 
@@ -818,19 +1386,27 @@ class SAR_Project:
 
         param: "terms": terminos con los que buscar relacionados
 
+        param: "verbose": mostrar la query sugerida ("Quizá quisiste decir")
+
         return: query modificada
-        """
 
-        sp = spellsuggest.TrieSpellSuggester("./vocabulary.txt")
+        El corrector se construye al indexar y se guarda con el indice; las sugerencias de cada
+        termino se recuerdan en self._suggestions.
+        """
         new_query = query
         for term in terms:
-            if term not in self.vocabulary:
-                rw = sp.suggest(term, threshold=self.threshold, distance=self.algorithm)
-                if rw:
-                    new_query = query.replace(term, list(rw)[0])
+            if not has_wildcard(term) and not self.in_vocabulary(term.lower()):
+                key = (term, self.threshold, self.algorithm)
+                if key not in self._suggestions:
+                    rw = self.get_suggester().suggest(term, threshold=self.threshold, distance=self.algorithm)
+                    # de las palabras sugeridas, la que aparece en mas noticias
+                    self._suggestions[key] = max(rw, key=self.df) if rw else None
+                if self._suggestions[key] is not None:
+                    new_query = query.replace(term, self._suggestions[key])
                     query = new_query
 
-        print("Quizá quisiste decir: ", new_query)
+        if verbose:
+            print("Quizá quisiste decir: ", new_query)
         return new_query
 
 
@@ -852,14 +1428,10 @@ class SAR_Project:
         return: el numero de noticias recuperadas, para la opcion -T
 
         """
-        result = self.solve_query(query)
-        if len(result[0]) == 0:
-            # ALGORITMICA
-            query = self.related(query, result[1])
-            result = self.solve_query(query)
-        print("%s\t%d" % (query, len(result[0])))
+        query, count = self.count(query, verbose=True)
+        print("%s\t%d" % (query, count))
 
-        return len(result)  # para verificar los resultados (op: -T)
+        return count  # para verificar los resultados (op: -T)
 
 
     def solve_and_show(self, query):
@@ -877,86 +1449,95 @@ class SAR_Project:
         return: el numero de noticias recuperadas, para la opcion -T
 
         """
-        sq = self.solve_query(query)
-        if(len(sq[0]) ==0):
-            # ALGORITMICA
-            query = self.related(query, sq[1])
-            sq = self.solve_query(query)
+        query, count, ids = self.search(query, verbose=True)
 
-        result = sq[0]
-        queryTerms = sq[1]
-        noticias = self.getNoticias()
-        if self.use_ranking:
-            result = self.rank_result(result, queryTerms)
-
-        print("Query: {}\nNumber of results: {}\n".format(query, len(result)))
-
-        if result != []:
-            #we get a list of all ids of the articles found
-            ids = [x.news_id for x in result]
-            #we change the int ids to the hashed ids of the articles
-            hids = list()
-            for id in ids:
-                aa = self.news[id].split("$$$")[1]
-                hids.append(aa)
-                hids = list(hids)
-                #we get the original articles based on their ids
-                articles = [x for x in noticias if x["id"] in hids]
+        print("Query: {}\nNumber of results: {}\n".format(query, count))
+
+        #each article is read from the document store with a single seek
+        articles = [self.get_news(news_id) for news_id in ids]
         if self.show_snippet:
-                self.print_snippet(articles, queryTerms, ids, 20)
+                self.print_snippet(articles, query, ids, self.SNIPPET_TOKENS)
         else:
             self.print_default(articles, ids)
-        return len(result)  # para verificar los resultados (op: -T)
+        return count  # para verificar los resultados (op: -T)
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+    def count(self, query, verbose=False):
+        """
+        Resuelve una consulta como solve_and_count pero devuelve el numero de resultados en vez
+        de mostrarlo (para SAR_Server). Si no hay resultados se prueba con la query corregida
+        por related, que solo se muestra con "verbose".
+
+        return: (query resuelta, numero de resultados)
+        """
+        result, terms = self.solve_query(query)
+        if len(result) == 0:
+            # ALGORITMICA
+            query = self.related(query, terms, verbose)
+            result, _ = self.solve_query(query)
+        #El resultado no se materializa: para un NOT, len() es N - |p|
+        return query, len(result)
+
+    def search(self, query, verbose=False):
+        """
+        Resuelve una consulta como solve_and_show pero devuelve los resultados en vez de mostrarlos
+        (para SAR_Server). Si no hay resultados se prueba con la query corregida por related,
+        que solo se muestra con "verbose".
+
+        return: (query resuelta, numero de resultados, newid de las noticias a mostrar en orden)
+        """
+        sq = self.solve_query(query)
+        if(len(sq[0]) ==0):
+            # ALGORITMICA
+            query = self.related(query, sq[1], verbose)
+            sq = self.solve_query(query)
+
+        result = sq[0].decode()
+        ids = []
+        if len(result) > 0:
+            #we get the ids of the articles to show
+            if self.use_ranking:
+                ids = self.rank_result(result, query)
+            else:
+                ids = list(result.ids)
+            if not self.show_all:
+                ids = ids[:self.SHOW_MAX]
+        return query, len(result), ids
+
     def print_default(self, articles, ids):
         id = 0
         for article in articles:
             print("#{} \t ({}) ({}) {} \t ({})".format(id, ids[id], article["date"], article["title"], article["keywords"]))
             id+=1
 
-    def getNoticias(self):
-        #we get a list of pairs [filename, news_id]
-        ndocs = self.news.values()
-        filenames = set()
-        newsid = set()
-        articles = list()
-        #we store all filenames and news_id to search
-        for ndoc in ndocs:
-            doc = ndoc.split("$$$")
-            filename = doc[0]
-            filenames.add(filename)
-            nid = doc[1]
-            newsid.add(nid)
-        filenames = list(filenames)
-        newsid = list(newsid)
-        for f in filenames:
-            with open(f) as fh:
-                jlist = json.load(fh)
-                articles += [x for x in jlist if x["id"] in newsid]
-        return articles
+    def get_news(self, news_id):
+        """
+        Devuelve la noticia "news_id" como diccionario (con los campos de DocStore.stored_fields),
+        con un unico acceso al document store.
+
+        """
+        return self.store.get(news_id)
 
     def print_snippet(self, articles, query, ids, range):
+        """
+        Muestra cada noticia con un snippet de "range" tokens del articulo: la ventana con mas
+        apariciones de los terminos de la query (ver snippet_hits).
+
+        Los limites de la ventana salen de los offsets de los tokens guardados al indexar
+        (DocStore, "spans"), asi que no se vuelve a recorrer el texto del articulo.
+        """
         id = 1
         i=0
         for article in articles:
             print("#{}\n{}\nDate: {}\nTitle: {}\nKeywords: {}".format(id, ids[id-1], article["date"], article["title"], article["keywords"]))
             id+=1
             i+=1
-            for token in query:
-                #let's try and find the first instance of the token in the articles of the result
-                text = article["article"].lower()
-                pos = text.find(str(token.lower()))
-                if(pos != -1):
-                    #we found the instance of token at pos, let's get a snippet
-                    lpos = max(0, text.rfind(" ", 0, pos-range)) #left side of the snippet
-                    rpos = min(len(text), text.find(" ",pos+range)) #right side of the snippet
-                    if(rpos == -1): rpos = len(text)
-                    snippet = article["article"][lpos:rpos]
-                    print("(#)..." + snippet + "...(#)")
+            snippet = self.make_snippet(ids[id-2], article, query, range)
+            if snippet:
+                print("(#)" + snippet + "(#)")
             if id-1 < len(ids):
                 print("-------------")
             if not(self.show_all) and i>9:
@@ -965,6 +1546,104 @@ class SAR_Project:
         return
 
 
+    def make_snippet(self, news_id, article, query, range):
+        """
+        Devuelve el snippet de "range" tokens de la noticia "news_id" ("article" es su diccionario
+        de get_news), con "..." si la ventana no llega al principio o al final del articulo.
+        """
+        text = article["article"]
+        spans = article.get("spans")
+        if spans is None:
+            spans = token_spans(text) # noticias guardadas sin offsets
+        starts, ends = decode_spans(spans)
+        if len(starts) == 0:
+            return ""
+        hits = self.snippet_hits(news_id, query, text, starts, ends)
+        first, last = densest_window(hits, range, len(starts))
+        snippet = text[starts[first]:ends[last]]
+        return ("..." if first > 0 else "") + snippet + ("..." if last < len(starts) - 1 else "")
+
+
+    def snippet_hits(self, news_id, query, text, starts, ends):
+        """
+        Devuelve los indices (ordenados) de los tokens del articulo "news_id" que son terminos de la query.
+
+        Con indice posicional las posiciones salen de las posting lists del campo article
+        (snippet_postings), sin recorrer el texto. Si no, se comparan los tokens del articulo
+        (cortados con sus offsets) con los de la query, o con sus stems si se usa stemming.
+        """
+        hits = set()
+        if self.positional:
+            for plist in self.snippet_postings(query):
+                cursor = PostingCursor(plist, full=True)
+                if cursor.next_geq(news_id) == news_id:
+                    hits.update(p - 1 for p in cursor.chunk.get_pos(cursor.i)) # las posiciones empiezan en 1
+            return sorted(hits)
+
+        tokens, wildcards = self.snippet_terms(query)
+        patterns = [re.compile("".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in term.lower()))
+                    for term in wildcards]
+        if self.use_stemming:
+            tokens = set(self.stemmer.stem(t) for t in tokens)
+        stems = {} # stem de cada palabra distinta del articulo
+        for k in range(len(starts)):
+            word = text[starts[k]:ends[k]].lower()
+            if self.use_stemming:
+                stem = stems.get(word)
+                if stem is None:
+                    stem = stems[word] = self.stemmer.stem(word)
+            else:
+                stem = word
+            if stem in tokens or any(p.fullmatch(word) for p in patterns):
+                hits.add(k)
+        return sorted(hits)
+
+
+    def snippet_terms(self, query):
+        """
+        return: (tokens de los terminos de la query en el campo article, terminos con comodines)
+        """
+        node, _ = parse_query(query)
+        tokens = set()
+        wildcards = []
+        pending = [node] if node is not None else []
+        while pending:
+            node = pending.pop()
+            if node.kind == TERM:
+                if node.field != 'article':
+                    continue
+                if has_wildcard(node.term) and node.term[0] != '"':
+                    wildcards.append(node.term)
+                else:
+                    tokens.update(self.tokenize(node.term))
+            elif node.kind != NOT:
+                pending.extend(node.children)
+        return tokens, wildcards
+
+
+    def snippet_postings(self, query):
+        """
+        Posting lists (con posiciones) del campo article de los terminos de la query, para
+        snippet_hits en un indice posicional: las de sus stems si se usa stemming (ver
+        stem_positions) y las de los terminos de cada comodin (expand_wildcard, sin stemming).
+
+        Se recuerdan las de la ultima query, que se usan para todos los resultados mostrados.
+        """
+        key = (query, self.use_stemming)
+        if self._snippet_postings is None or self._snippet_postings[0] != key:
+            tokens, wildcards = self.snippet_terms(query)
+            table = self.index['article']
+            if self.use_stemming:
+                stems = self.sindex['article']
+                plists = [stems[stem] for stem in set(self.stemmer.stem(t) for t in tokens) if stem in stems]
+            else:
+                plists = [table[t] for t in tokens if t in table]
+            for term in wildcards:
+                plists.extend(table[t] for t in self.expand_wildcard(term, 'article'))
+            self._snippet_postings = (key, plists)
+        return self._snippet_postings[1]
+
+
     def rank_result(self, result, query):
         """
         NECESARIO PARA LA AMPLIACION DE RANKING
@@ -975,45 +1654,324 @@ class SAR_Project:
                 "query": query, puede ser la query original, la query procesada o una lista de terminos
 
 
-        return: la lista de resultados ordenada
+        return: la lista de resultados ordenada (sus newid, de mayor a menor puntuacion)
+
+        Cada noticia se puntua con BM25 sumando, por cada termino no negado de la query, el peso
+        del termino en su campo. Si no se muestran todos los resultados solo se ordenan los
+        SHOW_MAX mejores, con un heap, y si la query es una disyuncion de terminos se usa WAND
+        (rank_wand) en vez de puntuar todas las noticias.
 
         """
+        terms, disjunctive = self.ranking_terms(query, with_kind=True)
+        if disjunctive and not self.show_all:
+            return self.rank_wand(terms, self.SHOW_MAX)
+        candidates = result.news_ids()
+        scores = dict.fromkeys(candidates, 0.0)
+        for term, field in terms:
+            plist = self.get_posting(term, field).decode()
+            ids, freqs = plist.ids, plist.freqs
+            weight = self.term_idf(term, field, len(plist))
+            lengths = self.doc_len[field]
+            norm = self.BM25_K1 * (1 - self.BM25_B)
+            slope = self.BM25_K1 * self.BM25_B / max(self.avgdl.get(field, 0), 1)
+            if len(candidates) < len(ids):
+                # pocos candidatos: se buscan en la lista
+                start = 0
+                matches = []
+                for news_id in candidates:
+                    start = gallop(ids, news_id, start)
+                    if start < len(ids) and ids[start] == news_id:
+                        matches.append(start)
+            else:
+                matches = [i for i, news_id in enumerate(ids) if news_id in scores]
+            for i in matches:
+                tf = freqs[i]
+                news_id = ids[i]
+                scores[news_id] += weight * tf * (self.BM25_K1 + 1) / (tf + norm + slope * lengths[news_id])
 
-        pass
+        key = lambda news_id: (-scores[news_id], news_id)
+        if self.show_all:
+            return sorted(scores, key=key)
+        return heapq.nsmallest(self.SHOW_MAX, scores, key=key)
 
-        ###################################################
-        ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE RANKING ##
-        ###################################################
 
-"""
-La idea de esta clase es que los posting de los índices sean objetos estructurados,
-aprovechar la orientación a objetos, en vez de hacerlo con listas. Sobretodo pensando
-en la mejora de las posicionales: para no tener que iterar por "listas de listas de listas".
-"""
-class Posting:
+    def ranking_terms(self, query, with_kind=False):
+        """
+        Devuelve los (termino, campo) de la query que puntuan en el ranking: los que no estan negados.
 
-    def __init__(self, news_id, frequency=None, pos=None):
-        self.news_id = news_id
-        if frequency is not None:
-            self.frequency = frequency
-        else:
-            self.frequency = 1
-        if pos is not None:
-            self.pos = pos
-        else:
-            self.pos = []
+        Con "with_kind" devuelve ademas si la query es una disyuncion (solo terminos y OR),
+        en cuyo caso el resultado booleano es la union de las listas de los terminos.
+        """
+        node, _ = parse_query(query)
+        terms = []
+        disjunctive = True
+        pending = [node] if node is not None else []
+        while pending:
+            node = pending.pop()
+            if node.kind == TERM:
+                terms.append((node.term, node.field))
+            else:
+                disjunctive = disjunctive and node.kind == OR
+                if node.kind != NOT:
+                    pending.extend(reversed(node.children))
+        if with_kind:
+            return terms, disjunctive
+        return terms
 
-    def __eq__(self, other):
-        if isinstance(other, Posting):
-            return self.news_id == other.news_id
-        else:
-            return NotImplemented
 
-    def __str__(self):
-        rep = "ID:{},freq:{}".format(self.news_id, self.frequency)
-        if len(self.pos) > 0:
-            rep += ",pos:" + str(self.pos[0])
-            for i in range(1,len(self.pos)):
-                rep += ", {}".format(self.pos[i])
+    def rank_wand(self, terms, k):
+        """
+        NECESARIO PARA LA AMPLIACION DE RANKING
+
+        Top-k de una disyuncion de terminos con WAND, documento a documento.
+
+        Cada termino tiene un cursor (PostingCursor) y una cota de su puntuacion (self.max_score,
+        o idf * (k1 + 1) para stems, comodines y frases). Con los cursores ordenados por noticia,
+        el pivote es la primera noticia en la que la suma de cotas de los cursores anteriores
+        supera la puntuacion del k-esimo mejor resultado; las noticias anteriores al pivote no
+        pueden entrar en el top-k y los cursores se adelantan hasta el con next_geq, saltando
+        los bloques que no hacen falta sin decodificarlos.
+
+        param:  "terms": lista de (termino, campo), ver ranking_terms
+                "k": numero de resultados
+
+        return: lista de newid ordenada de mayor a menor puntuacion (empates por newid)
+        """
+        k1 = self.BM25_K1
+        postings = []
+        for term, field in terms:
+            plist = self.get_posting(term, field)
+            if len(plist) == 0:
+                continue
+            idf = self.term_idf(term, field, len(plist))
+            bound = None
+            if term[0] != '"' and not self.use_stemming and not has_wildcard(term):
+                bound = self.max_score.get(field, {}).get(self.tokenize(term)[0])
+            if bound is None:
+                bound = idf * (k1 + 1)
+            norm = k1 * (1 - self.BM25_B)
+            slope = k1 * self.BM25_B / max(self.avgdl.get(field, 0), 1)
+            cursor = PostingCursor(plist, full=True, positions=False)
+            postings.append([cursor.next_geq(0), cursor, bound, idf, norm, slope, self.doc_len[field]])
+
+        heap = [] # (puntuacion, -newid) de los k mejores, el peor arriba
+        threshold = -1.0
+        active = [p for p in postings if p[0] is not None]
+        while active:
+            active.sort(key=lambda p: p[0])
+            acc = 0.0
+            pivot = None
+            for p in active:
+                acc += p[2]
+                if acc > threshold - 1e-9:
+                    pivot = p[0]
+                    break
+            if pivot is None:
+                break
+            if active[0][0] == pivot:
+                # se puntua la noticia, sumando en el orden de la query como rank_result
+                score = 0.0
+                for p in postings:
+                    if p[0] == pivot:
+                        tf = p[1].freq()
+                        score += p[3] * tf * (k1 + 1) / (tf + p[4] + p[5] * p[6][pivot])
+                        p[0] = p[1].next_geq(pivot + 1)
+                entry = (score, -pivot)
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+                if len(heap) == k:
+                    threshold = heap[0][0]
+            else:
+                for p in active:
+                    if p[0] >= pivot:
+                        break
+                    p[0] = p[1].next_geq(pivot)
+            active = [p for p in active if p[0] is not None]
+        return [-news_id for score, news_id in sorted(heap, reverse=True)]
+
+
+    def term_idf(self, term, field, df):
+        """
+        idf de un termino de la query: el precalculado en make_weights si es un termino del indice,
+        si no (stems, comodines, frases) se calcula con "df".
+        """
+        if term[0] != '"' and not self.use_stemming and not has_wildcard(term):
+            term_t = self.tokenize(term)
+            if term_t and term_t[0] in self.weight.get(field, {}):
+                return self.weight[field][term_t[0]]
+        return self.idf(df)
+
+
+def iter_json_array(fh, chunk_size=1 << 16):
+    """
+    Parser incremental de un fichero con un array JSON: devuelve los elementos uno a uno
+    leyendo el fichero por bloques de "chunk_size" caracteres.
+
+    param:  "fh": fichero abierto en modo texto
+            "chunk_size": tamaño de lectura
 
-        return rep
+    return: generador con los elementos del array
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # saltamos blancos, pidiendo mas texto si se acaba el buffer
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf = fh.read(chunk_size)
+            pos = 0
+            eof = len(buf) == 0
+        if pos == len(buf):
+            if started:
+                raise ValueError("iter_json_array: falta el ']' final")
+            return # fichero vacio
+
+        ch = buf[pos]
+        if not started:
+            if ch != '[':
+                raise ValueError("iter_json_array: el fichero no es un array JSON")
+            started = True
+            pos += 1
+            continue
+        if ch == ']':
+            return
+        if ch == ',':
+            pos += 1
+            continue
+
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            end = None
+        if end is None or (end == len(buf) and not eof):
+            # el elemento esta cortado al final del buffer: leemos mas (al menos lo que ya hay,
+            # para que el coste de reintentar sea lineal) y descartamos lo ya consumido
+            if eof:
+                raise ValueError("iter_json_array: JSON incompleto")
+            more = fh.read(max(chunk_size, len(buf) - pos))
+            eof = len(more) == 0
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield obj
+        pos = end
+
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize_spans(text):
+    """
+    Tokeniza "text" como SAR_Project.tokenize y a la vez calcula los offsets de los tokens,
+    en una sola pasada. Los offsets son del texto original (solo se pasa a minusculas cada
+    token), asi que sirven para cortar "text" aunque las minusculas cambien su longitud.
+
+    return: (lista de tokens, offsets como en token_spans)
+    """
+    tokens = []
+    spans = []
+    end = 0
+    for m in _WORD.finditer(text):
+        start = m.start()
+        tokens.append(m.group().lower())
+        spans.append(start - end)
+        end = m.end()
+        spans.append(end - start)
+    return tokens, spans
+
+
+def token_spans(text):
+    """
+    Offsets de los tokens de "text" (los mismos que da SAR_Project.tokenize) codificados como
+    diferencias: por cada token, distancia desde el final del anterior y longitud.
+    """
+    return tokenize_spans(text)[1]
+
+
+def decode_spans(spans):
+    """
+    return: (inicio, fin) de cada token, a partir de la salida de token_spans
+    """
+    starts = array('I')
+    ends = array('I')
+    end = 0
+    for k in range(0, len(spans), 2):
+        start = end + spans[k]
+        end = start + spans[k + 1]
+        starts.append(start)
+        ends.append(end)
+    return starts, ends
+
+
+def densest_window(hits, size, ntokens):
+    """
+    Elige la ventana de "size" tokens con mas apariciones ("hits", ordenados) de la query, centrada en ellas.
+
+    return: (primer token, ultimo token) de la ventana
+    """
+    best_l, best_r = 0, -1
+    l = 0
+    for r in range(len(hits)):
+        while hits[r] - hits[l] >= size:
+            l += 1
+        if r - l > best_r - best_l:
+            best_l, best_r = l, r
+    if best_r < 0:
+        first = 0
+    else:
+        first = (hits[best_l] + hits[best_r]) // 2 - size // 2
+    first = max(0, min(first, ntokens - size))
+    return first, min(ntokens, first + size) - 1
+
+
+_batch_project = None # indice cargado en cada proceso de solve_batch
+
+
+def _init_batch_worker(config):
+    global _batch_project
+    path, use_stemming = config
+    _batch_project = SAR_Project.load(path)
+    _batch_project.set_stemming(use_stemming)
+
+
+def _solve_batch_chunk(queries):
+    """
+    Funcion de los procesos de solve_batch. Los resultados se devuelven descomprimidos
+    (las listas del indice apuntan al mmap del proceso).
+    """
+    return [(query, result.decode(), t) for query, result, t in _batch_project.solve_batch(queries)]
+
+
+def _stem_words(words):
+    """
+    Funcion de los procesos de make_stemming: devuelve el stem de cada palabra de "words".
+    """
+    stemmer = SnowballStemmer('spanish')
+    return [stemmer.stem(word) for word in words]
+
+
+def _index_shard(shard):
+    """
+    Funcion de los procesos de index_parallel: indexa una lista de ficheros en un SAR_Project nuevo.
+
+    param:  "shard": tupla ((sections, positional), lista de ficheros)
+
+    return: (docs, news, index empaquetado con pack_table, vocabulario, store, doc_len) del indice parcial
+    """
+    (sections, positional), filenames = shard
+    partial = SAR_Project()
+    partial.sections = sections
+    partial.positional = positional
+    for filename in filenames:
+        partial.index_file(filename)
+    index = {section: pack_table(table) for section, table in partial.index.items()}
+    return partial.docs, partial.news, index, partial.vocabulary, partial.store, partial.doc_len
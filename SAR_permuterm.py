@@ -0,0 +1,100 @@
+import re
+from array import array
+from bisect import bisect_left
+
+
+"""
+Indice permuterm para las consultas con comodines (* y ?).
+
+Cada termino "t" se guarda con todas las rotaciones de "t$" ordenadas, pero sin guardar las
+cadenas rotadas: una entrada es solo (id del termino, desplazamiento de la rotacion) en dos
+arrays tipados, y la rotacion se reconstruye al compararla durante la busqueda binaria.
+En un indice guardado los ids son los del lexicon y los arrays estan en terms.bin (SAR_storage).
+
+Una consulta "X*Y" se rota a "Y$X*" y sus terminos son los de las rotaciones que empiezan
+por "Y$X". Con varios comodines se busca por el prefijo que queda hasta el primer comodin
+tras rotar y los candidatos se filtran con una expresion regular.
+"""
+
+END = "$"
+WILDCARDS = "*?"
+_MAX_CHAR = chr(0x10FFFF)
+
+
+def has_wildcard(term):
+    return any(c in term for c in WILDCARDS)
+
+
+class _Rotations:
+    """
+    Vista de solo lectura de las rotaciones ordenadas, para usarla con bisect.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index.term_ids)
+
+    def __getitem__(self, k):
+        return self.index.rotation(k)
+
+
+class PermutermIndex:
+
+    def __init__(self, terms, ids=None, rotations=None):
+        """
+        param:  "terms": terminos a indexar, se numeran por orden
+                         o, con "ids", secuencia id -> termino (p.ej. SAR_lexicon.Lexicon)
+                "ids": ids de los terminos de "terms" que se indexan
+                "rotations": (term_ids, shifts) ya ordenados, los de un indice guardado
+
+        Con un Lexicon los terminos no se copian: las rotaciones se reconstruyen con lexicon[id].
+        """
+        if ids is None and rotations is None:
+            terms = sorted(terms)
+            ids = range(len(terms))
+        self.terms = terms
+        if rotations is None:
+            entries = [(i, r) for i in ids for r in range(len(terms[i]) + 1)]
+            entries.sort(key=lambda e: self._rotate(terms[e[0]], e[1]))
+            rotations = (array('I', (i for i, _ in entries)), array('H', (r for _, r in entries)))
+        self.term_ids, self.shifts = rotations
+
+    @staticmethod
+    def _rotate(term, r):
+        s = term + END
+        return s[r:] + s[:r]
+
+    def rotation(self, k):
+        return self._rotate(self.terms[self.term_ids[k]], self.shifts[k])
+
+    def expand(self, pattern):
+        """
+        Devuelve los terminos que encajan con "pattern" ("*": cualquier secuencia, "?": un caracter),
+        en orden alfabetico.
+        """
+        s = pattern + END
+        last = max(s.rfind(c) for c in WILDCARDS)
+        s = s[last + 1:] + s[:last + 1]
+        # sin comodines se buscan las rotaciones "pattern$..." (terminos que acaban en "pattern")
+        # y la expresion regular deja solo el propio termino
+        cut = [i for i, c in enumerate(s) if c in WILDCARDS]
+        prefix = s[:cut[0]] if cut else s
+
+        rotations = _Rotations(self)
+        lo = bisect_left(rotations, prefix)
+        hi = bisect_left(rotations, prefix + _MAX_CHAR, lo)
+        regex = re.compile("".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in pattern))
+        words = [self.terms[i] for i in sorted(set(self.term_ids[lo:hi]))]
+        return [word for word in words if regex.fullmatch(word)]
+
+    def nbytes(self):
+        """
+        Bytes de los arrays de rotaciones (sin contar los terminos).
+        """
+        return self.term_ids.itemsize * len(self.term_ids) + self.shifts.itemsize * len(self.shifts)
+
+    def __len__(self):
+        # numero de permuterms
+        return len(self.term_ids)
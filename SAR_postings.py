@@ -0,0 +1,674 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, repeat
+
+
+"""
+La idea de esta clase es que los posting de los índices sean objetos estructurados,
+aprovechar la orientación a objetos, en vez de hacerlo con listas. Sobretodo pensando
+en la mejora de las posicionales: para no tener que iterar por "listas de listas de listas".
+"""
+class Posting:
+
+    def __init__(self, news_id, frequency=None, pos=None):
+        self.news_id = news_id
+        if frequency is not None:
+            self.frequency = frequency
+        else:
+            self.frequency = 1
+        if pos is not None:
+            self.pos = pos
+        else:
+            self.pos = []
+
+    def __eq__(self, other):
+        if isinstance(other, Posting):
+            return self.news_id == other.news_id
+        else:
+            return NotImplemented
+
+    def __str__(self):
+        rep = "ID:{},freq:{}".format(self.news_id, self.frequency)
+        if len(self.pos) > 0:
+            rep += ",pos:" + str(self.pos[0])
+            for i in range(1,len(self.pos)):
+                rep += ", {}".format(self.pos[i])
+
+        return rep
+
+
+"""
+Un objeto Posting por (termino, noticia, campo) son cientos de miles de objetos en el heap
+para un año de noticias. PostingList guarda la misma información en arrays tipados:
+
+    ids[i]                                  -> news_id del posting i
+    freqs[i]                                -> frecuencia del término en la noticia
+    positions[offsets[i]:offsets[i+1]]      -> posiciones del término en la noticia
+
+Se indexa como una lista de Posting (p[i].news_id sigue funcionando) pero las operaciones
+de SAR_Project trabajan directamente con los arrays.
+"""
+class PostingList:
+
+    __slots__ = ('ids', 'freqs', 'offsets', 'positions')
+
+    def __init__(self):
+        self.ids = array('I')
+        self.freqs = array('I')
+        self.offsets = array('I', [0])
+        self.positions = array('I')
+
+    def append(self, news_id, frequency=1, pos=None):
+        """
+        Añade un posting al final de la lista. Los news_id deben añadirse en orden creciente.
+        """
+        self.ids.append(news_id)
+        self.freqs.append(frequency)
+        if pos:
+            self.positions.extend(pos)
+        self.offsets.append(len(self.positions))
+
+    def append_from(self, other, i):
+        """
+        Copia el posting i de "other" al final de la lista.
+        """
+        self.ids.append(other.ids[i])
+        self.freqs.append(other.freqs[i])
+        start, end = other.offsets[i], other.offsets[i + 1]
+        if end > start:
+            self.positions.extend(other.positions[start:end])
+        self.offsets.append(len(self.positions))
+
+    def extend_from(self, other, start=0, stop=None, shift=0):
+        """
+        Copia los postings [start, stop) de "other" al final de la lista.
+        Si "shift" no es 0 se suma a los news_id copiados (util al fusionar indices parciales).
+        """
+        if stop is None:
+            stop = len(other.ids)
+        if start >= stop:
+            return
+        base = len(self.positions) - other.offsets[start]
+        if shift:
+            self.ids.extend(array('I', map(shift.__add__, other.ids[start:stop])))
+        else:
+            self.ids.extend(other.ids[start:stop])
+        self.freqs.extend(other.freqs[start:stop])
+        self.positions.extend(other.positions[other.offsets[start]:other.offsets[stop]])
+        self.offsets.extend(off + base for off in other.offsets[start + 1:stop + 1])
+
+    def without(self, news_ids):
+        """
+        Devuelve una copia de la lista sin los postings cuyo news_id esta en el conjunto "news_ids".
+        """
+        if not any(x in news_ids for x in self.ids):
+            return self
+        res = PostingList()
+        for i, x in enumerate(self.ids):
+            if x not in news_ids:
+                res.append_from(self, i)
+        return res
+
+    def get_pos(self, i):
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def compress(self):
+        """
+        return: la lista comprimida por bloques (CompressedPostingList)
+        """
+        return CompressedPostingList.from_postings(self)
+
+    def decode(self):
+        # una PostingList ya esta descomprimida
+        return self
+
+    def news_ids(self):
+        return self.ids
+
+    def nbytes(self):
+        """
+        Bytes ocupados por los arrays de la posting list.
+        """
+        return sum(a.itemsize * len(a) for a in (self.ids, self.freqs, self.offsets, self.positions))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            res = PostingList()
+            start, stop, step = i.indices(len(self.ids))
+            if step == 1:
+                res.extend_from(self, start, max(start, stop))
+            else:
+                for k in range(start, stop, step):
+                    res.append_from(self, k)
+            return res
+        if i < 0:
+            i += len(self.ids)
+        return Posting(self.ids[i], self.freqs[i], list(self.get_pos(i)))
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, PostingList):
+            return (self.ids == other.ids and self.freqs == other.freqs
+                    and self.offsets == other.offsets and self.positions == other.positions)
+        else:
+            return NotImplemented
+
+    def __repr__(self):
+        return "PostingList({})".format(list(self.ids))
+
+
+def merge_postings(plists, positions=False):
+    """
+    Une con un merge de k vias las posting lists "plists" (ordenadas por news_id).
+
+    El resultado solo guarda los news_id y la suma de las frecuencias, sin posiciones:
+    es lo que necesita el indice de stems, que solo se usa en consultas no posicionales.
+    Con "positions" se guardan tambien las posiciones de cada noticia, ordenadas (las de
+    los snippets con stemming, ver SAR_Project.snippet_hits).
+
+    return: PostingList
+    """
+    res = PostingList()
+    plists = [p.decode() for p in plists]
+    if positions:
+        if len(plists) == 1:
+            res.extend_from(plists[0])
+            return res
+        last = None
+        freq = 0
+        pos = []
+        for x, k, i in heapq.merge(*(zip(p.ids, repeat(k), range(len(p))) for k, p in enumerate(plists))):
+            if x != last:
+                if last is not None:
+                    res.append(last, freq, sorted(pos))
+                last, freq, pos = x, 0, []
+            freq += plists[k].freqs[i]
+            pos.extend(plists[k].get_pos(i))
+        if last is not None:
+            res.append(last, freq, sorted(pos))
+        return res
+    if len(plists) == 1:
+        res.ids = array('I', plists[0].ids)
+        res.freqs = array('I', plists[0].freqs)
+    else:
+        ids, freqs = res.ids, res.freqs
+        last = None
+        for x, f in heapq.merge(*(zip(p.ids, p.freqs) for p in plists)):
+            if x == last:
+                freqs[-1] += f
+            else:
+                ids.append(x)
+                freqs.append(f)
+                last = x
+    res.offsets = array('I', bytes(res.offsets.itemsize * (len(res.ids) + 1)))
+    return res
+
+
+
+def vbyte_encode(values, out):
+    """
+    Añade a "out" (bytearray) los enteros de "values" en variable-byte:
+    7 bits por byte, el ultimo byte de cada numero lleva el bit alto a 1.
+    """
+    for v in values:
+        while v >= 128:
+            out.append(v & 127)
+            v >>= 7
+        out.append(v | 128)
+
+
+def vbyte_decode(data, pos, count):
+    """
+    Decodifica "count" enteros variable-byte de "data" empezando en "pos".
+
+    return: (array con los enteros, posicion siguiente en "data")
+    """
+    out = array('I')
+    val = 0
+    shift = 0
+    while count:
+        b = data[pos]
+        pos += 1
+        if b < 128:
+            val |= b << shift
+            shift += 7
+        else:
+            out.append(val | ((b & 127) << shift))
+            val = 0
+            shift = 0
+            count -= 1
+    return out, pos
+
+
+"""
+Posting list comprimida por bloques de BLOCK_SIZE postings.
+
+Cada bloque guarda en "data" los news_id como diferencias (gaps) con el anterior seguidos de
+las frecuencias, y en "pos_data" para cada posting su numero de posiciones seguido de las
+posiciones como gaps; todo en variable-byte. Por bloque se guarda el ultimo news_id
+("last_ids") y donde empieza en "data" y "pos_data", asi cada bloque se decodifica por
+separado y las operaciones pueden saltarse los bloques que no necesitan.
+"""
+class CompressedPostingList:
+
+    BLOCK_SIZE = 128
+
+    __slots__ = ('n', 'npos', 'last_ids', 'id_offs', 'pos_offs', 'data', 'pos_data')
+
+    def __init__(self):
+        self.n = 0
+        self.npos = 0
+        self.last_ids = array('I')
+        self.id_offs = array('I', [0])
+        self.pos_offs = array('I', [0])
+        self.data = b''
+        self.pos_data = b''
+
+    @classmethod
+    def from_postings(cls, plist):
+        res = cls()
+        data = bytearray()
+        pos_data = bytearray()
+        ids = plist.ids
+        freqs = plist.freqs
+        offsets = plist.offsets
+        positions = plist.positions
+        has_pos = offsets[-1] > offsets[0]
+        prev = 0
+        for start in range(0, len(ids), cls.BLOCK_SIZE):
+            stop = min(start + cls.BLOCK_SIZE, len(ids))
+            block = ids[start:stop]
+            gaps = [block[0] - prev]
+            gaps.extend(block[k] - block[k - 1] for k in range(1, len(block)))
+            vbyte_encode(gaps, data)
+            vbyte_encode(freqs[start:stop], data)
+            prev = block[-1]
+            if has_pos:
+                for k in range(start, stop):
+                    pos = positions[offsets[k]:offsets[k + 1]]
+                    gaps = [len(pos)]
+                    last = 0
+                    for p in pos:
+                        gaps.append(p - last)
+                        last = p
+                    vbyte_encode(gaps, pos_data)
+            res.last_ids.append(prev)
+            res.id_offs.append(len(data))
+            res.pos_offs.append(len(pos_data))
+        res.n = len(ids)
+        res.npos = offsets[-1] - offsets[0]
+        res.data = bytes(data)
+        res.pos_data = bytes(pos_data)
+        return res
+
+    def nblocks(self):
+        return len(self.last_ids)
+
+    def block_ids(self, b):
+        """
+        Decodifica solo los news_id del bloque b.
+        """
+        count = min(self.BLOCK_SIZE, self.n - b * self.BLOCK_SIZE)
+        gaps, _ = vbyte_decode(self.data, self.id_offs[b], count)
+        prev = self.last_ids[b - 1] if b > 0 else 0
+        for k in range(count):
+            prev += gaps[k]
+            gaps[k] = prev
+        return gaps
+
+    def block(self, b, positions=True):
+        """
+        Decodifica el bloque b entero (sin las posiciones si "positions" es False).
+
+        return: PostingList con los postings del bloque
+        """
+        count = min(self.BLOCK_SIZE, self.n - b * self.BLOCK_SIZE)
+        res = PostingList()
+        gaps, p = vbyte_decode(self.data, self.id_offs[b], count)
+        prev = self.last_ids[b - 1] if b > 0 else 0
+        for k in range(count):
+            prev += gaps[k]
+            gaps[k] = prev
+        res.ids = gaps
+        res.freqs, _ = vbyte_decode(self.data, p, count)
+        p = self.pos_offs[b]
+        if p == self.pos_offs[b + 1] or not positions:
+            res.offsets = array('I', bytes(4 * (count + 1)))
+            return res
+        positions = res.positions
+        offsets = res.offsets
+        data = self.pos_data
+        for k in range(count):
+            npos, p = vbyte_decode(data, p, 1)
+            gaps, p = vbyte_decode(data, p, npos[0])
+            last = 0
+            for g in gaps:
+                last += g
+                positions.append(last)
+            offsets.append(len(positions))
+        return res
+
+    def blocks(self, positions=True):
+        for b in range(len(self.last_ids)):
+            yield self.block(b, positions)
+
+    def decode(self):
+        """
+        Descomprime la lista entera, bloque a bloque.
+
+        return: PostingList
+        """
+        res = PostingList()
+        for block in self.blocks():
+            res.extend_from(block)
+        return res
+
+    def news_ids(self):
+        """
+        Decodifica solo los news_id de todos los bloques.
+        """
+        res = array('I')
+        for b in range(len(self.last_ids)):
+            res.extend(self.block_ids(b))
+        return res
+
+    def compress(self):
+        return self
+
+    def nbytes(self):
+        """
+        Bytes ocupados por la lista comprimida (datos y cabeceras de bloque).
+        """
+        return (len(self.data) + len(self.pos_data)
+                + 4 * (len(self.last_ids) + len(self.id_offs) + len(self.pos_offs)))
+
+    def raw_nbytes(self):
+        """
+        Bytes que ocuparia la misma lista sin comprimir (PostingList).
+        """
+        return 4 * (3 * self.n + 1 + self.npos)
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return "CompressedPostingList(n={}, blocks={})".format(self.n, len(self.last_ids))
+
+
+
+
+
+# posiciones de los bits a 1 de cada valor de byte, para recorrer bitmaps
+_BYTE_BITS = [tuple(b for b in range(8) if v >> b & 1) for v in range(256)]
+
+
+"""
+Conjunto de noticias como bitmap: el bit k del entero "bits" esta a 1 si la noticia k esta en la lista.
+
+Los terminos muy frecuentes (df por encima de un umbral, ver SAR_Project.BITMAP_RATIO) guardan su
+conjunto de documentos asi; AND, OR y NOT entre bitmaps son operaciones de bits de los enteros de
+python, que se hacen palabra a palabra en C. "payload" es la CompressedPostingList del termino con las
+frecuencias y posiciones; los bitmaps que salen de operar no la tienen.
+"""
+class BitmapPostingList:
+
+    __slots__ = ('bits', 'payload', 'count', '_bytes')
+
+    def __init__(self, bits, payload=None):
+        self.bits = bits
+        self.payload = payload
+        self.count = None
+        self._bytes = None
+
+    @classmethod
+    def from_ids(cls, ids, payload=None):
+        if len(ids) == 0:
+            return cls(0, payload)
+        data = bytearray(ids[-1] // 8 + 1)
+        for x in ids:
+            data[x >> 3] |= 1 << (x & 7)
+        return cls(int.from_bytes(data, 'little'), payload)
+
+    @staticmethod
+    def bits_of(plist):
+        """
+        return: el bitmap (entero) de cualquier posting list
+        """
+        if isinstance(plist, BitmapPostingList):
+            return plist.bits
+        return BitmapPostingList.from_ids(plist.news_ids()).bits
+
+    def to_bytes(self):
+        if self._bytes is None:
+            self._bytes = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        return self._bytes
+
+    def contains(self, x):
+        data = self.to_bytes()
+        return (x >> 3) < len(data) and (data[x >> 3] >> (x & 7)) & 1 == 1
+
+    def filter(self, plist, keep=True):
+        """
+        Filtra una PostingList por el bitmap.
+
+        return: PostingList con los postings de "plist" que estan (keep=True) o no estan (keep=False) en el bitmap
+        """
+        res = PostingList()
+        data = self.to_bytes()
+        size = len(data)
+        for i, x in enumerate(plist.ids):
+            inside = (x >> 3) < size and (data[x >> 3] >> (x & 7)) & 1 == 1
+            if inside == keep:
+                res.append_from(plist, i)
+        return res
+
+    def news_ids(self):
+        res = array('I')
+        for k, byte in enumerate(self.to_bytes()):
+            if byte:
+                base = k << 3
+                res.extend(base + b for b in _BYTE_BITS[byte])
+        return res
+
+    def decode(self):
+        """
+        return: PostingList con los postings completos si hay payload, o solo con los news_id
+        """
+        if self.payload is not None:
+            return self.payload.decode()
+        res = PostingList()
+        res.ids = self.news_ids()
+        res.freqs = array('I', [1]) * len(res.ids)
+        res.offsets = array('I', [0]) * (len(res.ids) + 1)
+        return res
+
+    def compress(self):
+        return self
+
+    def nbytes(self):
+        payload = self.payload.nbytes() if self.payload is not None else 0
+        return payload + len(self.to_bytes())
+
+    def raw_nbytes(self):
+        if self.payload is not None:
+            return self.payload.raw_nbytes()
+        return 4 * (3 * len(self) + 1)
+
+    def __len__(self):
+        if self.count is None:
+            self.count = self.bits.bit_count() if hasattr(self.bits, 'bit_count') else bin(self.bits).count('1')
+        return self.count
+
+    def __repr__(self):
+        return "BitmapPostingList(n={})".format(len(self))
+
+
+"""
+Complemento perezoso de una posting list: todas las noticias de "universe" salvo las de "plist".
+
+SAR_Project.reverse_posting la devuelve en vez de construir la lista de las N - |p| noticias;
+and_posting, or_posting y minus_posting la combinan simbolicamente (a AND NOT b es a - b,
+NOT a AND NOT b es NOT (a OR b), ...) y solo se materializa con decode() cuando una negacion
+es el resultado final de la consulta.
+"""
+class NotPostingList:
+
+    __slots__ = ('plist', 'universe')
+
+    def __init__(self, plist, universe):
+        self.plist = plist
+        self.universe = universe # news_id de la coleccion en orden creciente (p.ej. las claves de SAR_Project.news)
+
+    def __len__(self):
+        return len(self.universe) - len(self.plist)
+
+    def decode(self):
+        """
+        Materializa el complemento recorriendo el universo (tiempo lineal con la coleccion).
+        Los postings no tienen frecuencia ni posiciones.
+        """
+        res = PostingList()
+        ids = self.plist.news_ids()
+        j = 0   #El índice de la noticia que queremos omitir
+        for key in self.universe:
+            if (j < len(ids) and key == ids[j]):
+                j+=1
+            else:
+                res.append(key)
+        return res
+
+    def news_ids(self):
+        return self.decode().ids
+
+    def __repr__(self):
+        return "NotPostingList({!r})".format(self.plist)
+
+
+def gallop(ids, x, lo=0):
+    """
+    Busqueda exponencial (galloping) en un array ordenado.
+
+    return: el primer indice >= lo tal que ids[indice] >= x (len(ids) si no hay ninguno)
+    """
+    n = len(ids)
+    if lo >= n or ids[lo] >= x:
+        return lo
+    step = 1
+    hi = lo + 1
+    while hi < n and ids[hi] < x:
+        lo = hi
+        step <<= 1
+        hi = lo + step
+    return bisect_left(ids, x, lo + 1, min(hi, n))
+
+
+class PostingCursor:
+    """
+    Recorre hacia delante una posting list (comprimida o no) saltando con next_geq.
+
+    En una CompressedPostingList los last_ids de cada bloque hacen de skip pointers:
+    los bloques que no pueden contener el news_id buscado no se decodifican. Dentro del
+    bloque (o de una PostingList) se avanza con galloping.
+
+    Si "full" es False solo se decodifican los news_id de los bloques; con True se
+    decodifican tambien frecuencias y posiciones (si "positions" es True) y
+    "chunk"/"i" dan el posting actual.
+    """
+
+    __slots__ = ('plist', 'compressed', 'full', 'positions', 'block', 'chunk', 'ids', 'i')
+
+    def __init__(self, plist, full=False, positions=True):
+        if isinstance(plist, BitmapPostingList):
+            plist = plist.payload if plist.payload is not None else plist.decode()
+        self.plist = plist
+        self.compressed = isinstance(plist, CompressedPostingList)
+        self.full = full
+        self.positions = positions
+        self.block = -1
+        self.chunk = plist
+        self.ids = plist.ids if not self.compressed else array('I')
+        self.i = 0
+        if self.compressed and len(plist) > 0:
+            self._load(0)
+
+    def _load(self, b):
+        self.block = b
+        if self.full:
+            self.chunk = self.plist.block(b, self.positions)
+            self.ids = self.chunk.ids
+        else:
+            self.ids = self.plist.block_ids(b)
+        self.i = 0
+
+    def next_geq(self, x):
+        """
+        Avanza hasta el primer posting con news_id >= x.
+
+        return: su news_id, o None si la lista se ha acabado
+        """
+        if self.compressed and self.block >= 0:
+            last_ids = self.plist.last_ids
+            if x > last_ids[self.block]:
+                b = bisect_left(last_ids, x, self.block + 1)
+                if b == len(last_ids):
+                    self.i = len(self.ids)
+                    return None
+                self._load(b)
+        self.i = gallop(self.ids, x, self.i)
+        if self.i == len(self.ids):
+            return None
+        return self.ids[self.i]
+
+    def freq(self):
+        # frecuencia del posting actual (solo con full=True)
+        return self.chunk.freqs[self.i]
+
+
+def pack_table(table):
+    """
+    Empaqueta un diccionario termino -> PostingList en unos pocos arrays contiguos.
+    Serializar (pickle) el resultado es mucho mas rapido que serializar una PostingList
+    por termino, util para pasar indices parciales entre procesos.
+
+    return: (terminos, dfs, ids, freqs, longitudes de posiciones, posiciones)
+    """
+    terms = list(table)
+    dfs = array('I')
+    ids = array('I')
+    freqs = array('I')
+    lens = array('I')
+    positions = array('I')
+    for term in terms:
+        plist = table[term]
+        dfs.append(len(plist.ids))
+        ids.extend(plist.ids)
+        freqs.extend(plist.freqs)
+        offsets = plist.offsets
+        lens.extend(offsets[k + 1] - offsets[k] for k in range(len(plist.ids)))
+        positions.extend(plist.positions[offsets[0]:offsets[-1]])
+    return terms, dfs, ids, freqs, lens, positions
+
+
+def unpack_table(packed):
+    """
+    Inversa de pack_table: genera los pares (termino, PostingList).
+    """
+    terms, dfs, ids, freqs, lens, positions = packed
+    i = 0
+    p = 0
+    for term, df in zip(terms, dfs):
+        plist = PostingList()
+        plist.ids = ids[i:i + df]
+        plist.freqs = freqs[i:i + df]
+        plist.offsets.extend(accumulate(lens[i:i + df]))
+        plist.positions = positions[p:p + plist.offsets[-1]]
+        p += plist.offsets[-1]
+        i += df
+        yield term, plist
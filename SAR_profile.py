@@ -0,0 +1,215 @@
+import json
+import time
+from collections import defaultdict
+
+from SAR_postings import NotPostingList
+
+
+"""
+Instrumentacion de las consultas (opcion --profile de SAR_Searcher.py).
+
+Profiler.attach(searcher) sustituye, solo en esa instancia, los metodos de cada etapa de una
+consulta por envolturas que miden su tiempo y cuentan lo que procesan. Sin --profile no se
+envuelve nada y no hay ningun coste.
+
+El tiempo de cada etapa es exclusivo (sin el de las etapas a las que llama), asi que la suma
+de las etapas es el tiempo de la consulta:
+    parse      -> solve_query sin lo demas: parse_query, plan (estimaciones) y explain
+    evaluate   -> evaluate sin lo demas: claves y accesos a la cache de consultas
+    posting    -> get_posting (listas de terminos, frases, stems y comodines)
+    and, or, minus, not
+               -> and_posting, or_posting, minus_posting, reverse_posting
+    related    -> related (sugerencias del corrector)
+    rank       -> rank_result
+    news       -> get_news (lectura de las noticias del document store)
+    snippet    -> make_snippet
+    show       -> solve_and_count, solve_and_show, count y search sin lo demas (decode, prints...)
+
+Contadores de cada consulta:
+    postings   -> postings de las listas devueltas por get_posting
+    merged     -> postings de entrada de and, or y minus (un NOT cuenta su lista sin negar)
+    allocated  -> postings de los resultados de and, or y minus (un NOT no se materializa)
+    bytes      -> bytes de las listas de get_posting y de los registros del document store
+
+Una consulta empieza con la primera llamada a solve_query, solve_and_count, solve_and_show,
+count o search y acaba cuando esa llamada vuelve. Ademas del detalle de cada consulta se acumulan,
+por etapa, las llamadas, el tiempo y un histograma del tiempo por consulta en potencias de 2
+de microsegundos, que SAR_Searcher.py muestra al terminar.
+"""
+
+STAGES = {
+    "solve_query": "parse",
+    "evaluate": "evaluate",
+    "get_posting": "posting",
+    "and_posting": "and",
+    "or_posting": "or",
+    "minus_posting": "minus",
+    "reverse_posting": "not",
+    "related": "related",
+    "rank_result": "rank",
+    "get_news": "news",
+    "make_snippet": "snippet",
+    "solve_and_count": "show",
+    "solve_and_show": "show",
+    "count": "show",
+    "search": "show",
+}
+
+# metodos que empiezan una consulta, el resto solo se miden dentro de una
+ENTRIES = ("solve_query", "solve_and_count", "solve_and_show", "count", "search")
+
+COUNTERS = ("postings", "merged", "allocated", "bytes")
+
+
+def _plain_len(plist):
+    return len(plist.plist) if isinstance(plist, NotPostingList) else len(plist)
+
+
+def _count_posting(searcher, counters, args, res):
+    counters["postings"] += len(res)
+    counters["bytes"] += res.nbytes()
+
+
+def _count_merge(searcher, counters, args, res):
+    counters["merged"] += _plain_len(args[0]) + _plain_len(args[1])
+    if not isinstance(res, NotPostingList):
+        counters["allocated"] += len(res)
+
+
+def _count_news(searcher, counters, args, res):
+    store = getattr(searcher, "store", None)
+    if store is not None:
+        news_id = args[0]
+        counters["bytes"] += store.offsets[news_id] - store.offsets[news_id - 1]
+
+
+COUNT = {
+    "get_posting": _count_posting,
+    "and_posting": _count_merge,
+    "or_posting": _count_merge,
+    "minus_posting": _count_merge,
+    "get_news": _count_news,
+}
+
+
+def bucket(seconds):
+    # cubeta b del histograma: tiempos < 2**b microsegundos
+    return int(seconds * 1e6).bit_length()
+
+
+class QueryTrace:
+
+    def __init__(self, query):
+        self.query = query
+        self.time = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def total(self):
+        return sum(self.time.values())
+
+    def lines(self):
+        res = ["Profile: {}\t{:.3f} ms".format(self.query, 1000 * self.total())]
+        for stage, t in sorted(self.time.items(), key=lambda st: -st[1]):
+            res.append("  {:<9}{:9.3f} ms  x{}".format(stage, 1000 * t, self.calls[stage]))
+        res.append("  " + "  ".join("{} {}".format(k, v) for k, v in self.counters.items()))
+        return res
+
+
+class Profiler:
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose  # mostrar el detalle de cada consulta al acabarla
+        self.trace = None       # consulta en curso
+        self.stack = []         # tiempo de las etapas hijas de cada llamada en curso
+        self.queries = 0
+        self.time = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.hist = defaultdict(lambda: defaultdict(int)) # etapa -> cubeta -> consultas
+
+    def attach(self, searcher):
+        for method, stage in STAGES.items():
+            setattr(searcher, method, self.wrap(searcher, method, stage))
+        return self
+
+    def detach(self, searcher):
+        for method in STAGES:
+            searcher.__dict__.pop(method, None)
+
+    def wrap(self, searcher, method, stage):
+        fn = getattr(searcher, method)
+        count = COUNT.get(method)
+        entry = method in ENTRIES
+
+        def timed(*args, **kwargs):
+            if not self.stack:
+                if not entry:
+                    return fn(*args, **kwargs)
+                self.trace = QueryTrace(args[0] if args else kwargs.get("query", ""))
+            trace = self.trace
+            self.stack.append(0.0)
+            t0 = time.perf_counter()
+            try:
+                res = fn(*args, **kwargs)
+            finally:
+                t = time.perf_counter() - t0
+                trace.time[stage] += t - self.stack.pop()
+                trace.calls[stage] += 1
+                if self.stack:
+                    self.stack[-1] += t
+                else:
+                    self.finish()
+            if count is not None:
+                # el tiempo de contar tampoco se le apunta a la etapa que llama
+                t0 = time.perf_counter()
+                count(searcher, trace.counters, args, res)
+                if self.stack:
+                    self.stack[-1] += time.perf_counter() - t0
+            return res
+
+        return timed
+
+    def finish(self):
+        trace = self.trace
+        self.trace = None
+        self.queries += 1
+        for stage, t in trace.time.items():
+            self.time[stage] += t
+            self.calls[stage] += trace.calls[stage]
+            self.hist[stage][bucket(t)] += 1
+        self.hist["query"][bucket(trace.total())] += 1
+        for k, v in trace.counters.items():
+            self.counters[k] += v
+        if self.verbose:
+            print("\n".join(trace.lines()))
+
+    def summary(self):
+        """
+        return: lineas con el resumen de todas las consultas: por etapa llamadas, tiempo total,
+                porcentaje, media por consulta e histograma (consultas con tiempo < N us)
+        """
+        total = sum(self.time.values())
+        res = ["Profile summary: {} queries, {:.3f} ms".format(self.queries, 1000 * total),
+               "  {:<9}{:>8}{:>12}{:>7}{:>12}  {}".format("stage", "calls", "total ms", "%", "ms/query", "histogram (<us: queries)")]
+        rows = sorted(self.time.items(), key=lambda st: -st[1]) + [("query", total)]
+        for stage, t in rows:
+            calls = self.calls[stage] if stage != "query" else self.queries
+            hist = " ".join("<{}:{}".format(2 ** b, n) for b, n in sorted(self.hist[stage].items()))
+            res.append("  {:<9}{:>8}{:>12.3f}{:>7.1f}{:>12.3f}  {}".format(
+                stage, calls, 1000 * t, 100 * t / total if total else 0,
+                1000 * t / self.queries if self.queries else 0, hist))
+        res.append("  " + "  ".join("{} {}".format(k, v) for k, v in self.counters.items()))
+        return res
+
+    def to_dict(self):
+        stages = {stage: {"calls": self.calls[stage], "total_ms": 1000 * t,
+                          "histogram_us": {str(2 ** b): n for b, n in sorted(self.hist[stage].items())}}
+                  for stage, t in self.time.items()}
+        stages["query"] = {"calls": self.queries, "total_ms": 1000 * sum(self.time.values()),
+                           "histogram_us": {str(2 ** b): n for b, n in sorted(self.hist["query"].items())}}
+        return {"queries": self.queries, "stages": stages, "counters": dict(self.counters)}
+
+    def dump(self, filename):
+        with open(filename, "w", encoding="utf-8") as fh:
+            json.dump(self.to_dict(), fh, indent=2)
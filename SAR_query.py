@@ -0,0 +1,279 @@
+import shlex
+from collections import OrderedDict
+
+
+"""
+Planificador de consultas booleanas.
+
+La consulta se parsea a un arbol (Node) con la misma semantica que tenia solve_query:
+los operadores AND y OR tienen la misma prioridad y se evaluan de izquierda a derecha,
+NOT afecta solo al operando siguiente y dos operandos seguidos llevan un AND implicito.
+
+Despues plan() reescribe el arbol:
+    - las cadenas de AND y de OR se aplanan en un solo nodo (son asociativos)
+    - se estima el numero de resultados de cada nodo a partir de las frecuencias de documento
+    - los operandos de AND se ordenan de menor a mayor y los negados van al final
+      ("NOT a AND b" se evalua como "b AND NOT a", con minus_posting)
+    - los operandos de OR se ordenan de menor a mayor
+
+Los resultados de cada nodo se pueden guardar en una QueryCache con la clave canonica del
+nodo (canonical), que no depende del orden de los operandos de AND y OR.
+"""
+
+AND = "AND"
+OR = "OR"
+NOT = "NOT"
+TERM = "TERM"
+
+
+class Node:
+
+    def __init__(self, kind, children=None, term=None, field='article'):
+        self.kind = kind
+        self.children = children if children is not None else []
+        self.term = term
+        self.field = field
+        self.est = None     # numero de resultados estimado
+        self.actual = None  # numero de resultados al evaluar (None si no se ha evaluado)
+        self.cached = False # True si el resultado ha salido de la cache
+        self.key = None     # clave canonica, ver canonical()
+        self.terms = None   # terminos de un comodin, se expande una vez al estimar
+
+    def label(self):
+        if self.kind == TERM:
+            return "{}:{}".format(self.field, self.term)
+        return self.kind
+
+    def __str__(self):
+        if self.kind == TERM:
+            return self.label()
+        if self.kind == NOT:
+            return "NOT {}".format(self.children[0])
+        return "(" + " {} ".format(self.kind).join(str(c) for c in self.children) + ")"
+
+
+def tokenize_query(query):
+    """
+    Divide la consulta en tokens: ("OP", operador), ("(",), (")",) y ("TERM", termino, campo).
+
+    shlex mantiene el texto entre comillas con posix=False y separa los paréntesis con
+    punctuation_chars=True (también separa los dos puntos de los campos: "title:valencia").
+    """
+    lexer = shlex.shlex(instream=query, posix=False, punctuation_chars=True)
+    lexer.wordchars += 'áéíóúüÁÉÍÓÚÜñ'
+    raw = []
+    t = lexer.get_token()
+    while t != '':
+        raw.append(t)
+        t = lexer.get_token()
+
+    tokens = []
+    k = 0
+    while k < len(raw):
+        t = raw[k]
+        if t in (AND, OR, NOT):
+            tokens.append(("OP", t))
+        elif t[0] in '()':
+            #Pueden haber varios parentesis en un token
+            for ch in t:
+                tokens.append((ch,))
+        elif k + 2 < len(raw) and raw[k + 1] == ':':
+            #multifield: t es el campo
+            tokens.append(("TERM", raw[k + 2], t))
+            k += 2
+        else:
+            tokens.append(("TERM", t, 'article'))
+        k += 1
+    return tokens
+
+
+def parse_query(query):
+    """
+    Parsea una consulta.
+
+    return: (arbol de la consulta o None si esta vacia, lista de terminos sin comillas)
+    """
+    tokens = tokenize_query(query)
+    terms = []
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def primary():
+        tok = peek()
+        if tok is None:
+            raise ValueError("parse_query: falta un operando en '{}'".format(query))
+        pos[0] += 1
+        if tok == ("OP", NOT):
+            return Node(NOT, [primary()])
+        if tok == ("(",):
+            node = expression()
+            if peek() == (")",):
+                pos[0] += 1
+            return node
+        if tok[0] == "TERM":
+            term = tok[1]
+            terms.append(term[1:-1] if term[0] == '"' else term)
+            return Node(TERM, term=term, field=tok[2])
+        raise ValueError("parse_query: token inesperado {} en '{}'".format(tok, query))
+
+    def expression():
+        node = primary()
+        while True:
+            tok = peek()
+            if tok is None or tok == (")",):
+                return node
+            if tok in (("OP", AND), ("OP", OR)):
+                pos[0] += 1
+                op = tok[1]
+            else:
+                op = AND  #dos operandos seguidos: AND implicito
+            node = Node(op, [node, primary()])
+
+    if len(tokens) == 0:
+        return None, terms
+    node = expression()
+    while pos[0] < len(tokens):
+        #parentesis de cierre sobrantes: se sigue como si no estuvieran
+        pos[0] += 1
+        if pos[0] < len(tokens):
+            node = Node(AND, [node, expression()])
+    return node, terms
+
+
+def plan(node, estimate, total):
+    """
+    Reescribe el arbol y estima el numero de resultados de cada nodo.
+
+    param:  "node": arbol de parse_query
+            "estimate": funcion (nodo TERM) -> numero de noticias que contienen su termino
+                        (puede apuntar en el nodo lo que necesite para evaluarlo, p.ej. "terms")
+            "total": numero de noticias de la coleccion
+
+    return: arbol reescrito (los nodos llevan la estimacion en "est")
+    """
+    if node.kind == TERM:
+        node.est = estimate(node)
+        return node
+
+    if node.kind == NOT:
+        node.children = [plan(node.children[0], estimate, total)]
+        node.est = total - node.children[0].est
+        return node
+
+    #AND / OR: se aplanan los hijos del mismo tipo
+    children = []
+    pending = list(node.children)
+    while pending:
+        child = pending.pop(0)
+        if child.kind == node.kind:
+            pending[0:0] = child.children
+        else:
+            children.append(plan(child, estimate, total))
+
+    ratios = [c.est / total if total else 0 for c in children]
+    if node.kind == AND:
+        positive = sorted((c for c in children if c.kind != NOT), key=lambda c: c.est)
+        negative = sorted((c for c in children if c.kind == NOT), key=lambda c: -c.est)
+        node.children = positive + negative
+        prob = 1.0
+        for r in ratios:
+            prob *= r
+        node.est = int(round(total * prob))
+        if positive:
+            node.est = min(node.est, positive[0].est)
+    else:
+        node.children = sorted(children, key=lambda c: c.est)
+        prob = 1.0
+        for r in ratios:
+            prob *= 1 - r
+        node.est = int(round(total * (1 - prob)))
+        node.est = max([node.est] + [c.est for c in children])
+    return node
+
+
+def count_nodes(node):
+    if node is None:
+        return 0
+    return 1 + sum(count_nodes(child) for child in node.children)
+
+
+def explain(node, depth=0):
+    """
+    return: lista de lineas con el plan, la estimacion y el tamaño real de cada nodo
+    """
+    actual = "skipped" if node.actual is None else node.actual
+    lines = ["{}{}  est={} actual={}{}".format("  " * depth, node.label(), node.est, actual,
+                                               " (cached)" if node.cached else "")]
+    for child in node.children:
+        lines += explain(child, depth + 1)
+    return lines
+
+
+def canonical(node, normalize):
+    """
+    Calcula (y guarda en node.key) la clave canonica de un nodo del plan: los operandos de
+    AND y OR van ordenados, asi "a AND b" y "b AND a" tienen la misma clave.
+
+    param:  "node": nodo de plan()
+            "normalize": funcion (termino, campo) -> forma normalizada del termino
+
+    return: clave (cadena)
+    """
+    if node.kind == TERM:
+        node.key = "{}:{}".format(node.field, normalize(node.term, node.field))
+    elif node.kind == NOT:
+        node.key = "NOT({})".format(canonical(node.children[0], normalize))
+    else:
+        keys = sorted(canonical(child, normalize) for child in node.children)
+        node.key = "{}({})".format(node.kind, ",".join(keys))
+    return node.key
+
+
+class QueryCache:
+    """
+    Cache LRU de resultados de consultas y subconsultas, con un maximo de "size" entradas.
+
+    Los resultados guardados no se modifican nunca (las operaciones de SAR_Project siempre
+    construyen listas nuevas), asi que se pueden devolver tal cual.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def resize(self, size):
+        # cambia el maximo de entradas, descartando las menos usadas si sobran
+        self.size = size
+        while len(self.entries) > max(size, 0):
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return "Query cache: {} hits, {} misses, {}/{} entries".format(
+            self.hits, self.misses, len(self.entries), self.size)
@@ -0,0 +1,179 @@
+import argparse
+import random
+import time
+from array import array
+from collections import deque
+
+
+"""
+Corrector ortografico sobre un trie del vocabulario.
+
+El trie se guarda en arrays (los nodos se numeran en anchura, asi los hijos de cada nodo
+son consecutivos) y se recorre en profundidad calculando una fila de la matriz de distancias
+por nodo. Solo se calculan las celdas de la banda |i - j| <= threshold (fuera de ella la
+distancia ya es mayor que el umbral) y no se baja por un nodo cuando todas las celdas de su
+fila superan el umbral, asi que el coste depende de la parte del trie cercana al termino y
+no del tamaño del vocabulario.
+
+Distancias:
+    levenshtein  -> insercion, borrado y sustitucion
+    restricted   -> ademas intercambio de dos letras seguidas (ab <-> ba), coste 1
+    intermediate -> ademas ab <-> bXa y aXb <-> ba, coste 2
+"""
+
+LEVENSHTEIN = 0
+RESTRICTED = 1
+INTERMEDIATE = 2
+
+DISTANCES = {
+    "levenshtein": LEVENSHTEIN,
+    "lev": LEVENSHTEIN,
+    "restricted": RESTRICTED,
+    "damerau_r": RESTRICTED,
+    "intermediate": INTERMEDIATE,
+    "damerau_i": INTERMEDIATE,
+}
+
+
+def distance(a, b, name="levenshtein"):
+    """
+    Distancia entre "a" y "b" con la matriz completa (referencia para probar TrieSuggester).
+    """
+    variant = DISTANCES[name]
+    D = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(len(a) + 1):
+        for j in range(len(b) + 1):
+            if i == 0 or j == 0:
+                D[i][j] = i + j
+                continue
+            d = min(D[i - 1][j] + 1, D[i][j - 1] + 1, D[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+            if variant and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                d = min(d, D[i - 2][j - 2] + 1)
+            if variant == INTERMEDIATE:
+                if i > 1 and j > 2 and a[i - 2] == b[j - 1] and a[i - 1] == b[j - 3]:
+                    d = min(d, D[i - 2][j - 3] + 2)
+                if i > 2 and j > 1 and a[i - 3] == b[j - 1] and a[i - 1] == b[j - 2]:
+                    d = min(d, D[i - 3][j - 2] + 2)
+            D[i][j] = d
+    return D[len(a)][len(b)]
+
+
+class TrieSuggester:
+
+    def __init__(self, vocabulary):
+        self.words = sorted(set(vocabulary))
+        labels = ["$"]                    # letra del nodo (la raiz no tiene)
+        self.word_of = array('i', [-1])   # palabra que termina en el nodo (-1 si ninguna)
+        self.first = array('I')           # hijos del nodo n: first[n] .. last[n]-1
+        self.last = array('I')
+        self.depth = 0
+        queue = deque([(0, len(self.words), 0)]) # palabras con el prefijo del nodo: words[lo:hi], y su longitud
+        while queue:
+            lo, hi, d = queue.popleft()
+            self.depth = max(self.depth, d)
+            if lo < hi and len(self.words[lo]) == d:
+                self.word_of[len(self.first)] = lo
+                lo += 1
+            self.first.append(len(labels))
+            while lo < hi:
+                c = self.words[lo][d]
+                end = lo + 1
+                while end < hi and self.words[end][d] == c:
+                    end += 1
+                labels.append(c)
+                self.word_of.append(-1)
+                queue.append((lo, end, d + 1))
+                lo = end
+            self.last.append(len(labels))
+        self.labels = "".join(labels)
+
+    def suggest(self, term, threshold=2, distance="levenshtein"):
+        """
+        Devuelve las palabras del vocabulario a distancia <= "threshold" de "term".
+
+        return: diccionario palabra -> distancia
+        """
+        variant = DISTANCES[distance]
+        k = threshold
+        m = len(term)
+        big = k + 1
+        labels, word_of, first, last = self.labels, self.word_of, self.first, self.last
+        rows = [None] * (self.depth + 1)
+        cand = [""] * (self.depth + 1)   # cand[i-1] es la letra i del prefijo del nodo actual
+        rows[0] = [j if j <= k else big for j in range(m + 1)]
+        res = {}
+        stack = [(n, 1) for n in range(last[0] - 1, first[0] - 1, -1)]
+        while stack:
+            n, i = stack.pop()
+            c = labels[n]
+            cand[i - 1] = c
+            prev = rows[i - 1]
+            row = [big] * (m + 1)
+            if i <= k:
+                row[0] = i
+            for j in range(max(1, i - k), min(m, i + k) + 1):
+                d = prev[j - 1] + (c != term[j - 1])
+                if prev[j] + 1 < d:
+                    d = prev[j] + 1
+                if row[j - 1] + 1 < d:
+                    d = row[j - 1] + 1
+                if variant and i > 1 and j > 1 and c == term[j - 2] and cand[i - 2] == term[j - 1]:
+                    d = min(d, rows[i - 2][j - 2] + 1)
+                if variant == INTERMEDIATE:
+                    if i > 1 and j > 2 and cand[i - 2] == term[j - 1] and c == term[j - 3]:
+                        d = min(d, rows[i - 2][j - 3] + 2)
+                    if i > 2 and j > 1 and cand[i - 3] == term[j - 1] and c == term[j - 2]:
+                        d = min(d, rows[i - 3][j - 2] + 2)
+                row[j] = d if d < big else big
+            rows[i] = row
+            if word_of[n] >= 0 and row[m] <= k:
+                res[self.words[word_of[n]]] = row[m]
+            if min(row) <= k:
+                stack.extend((child, i + 1) for child in range(last[n] - 1, first[n] - 1, -1))
+        return res
+
+    def __len__(self):
+        return len(self.words)
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: TrieSuggester contra spellsuggest (si esta instalado) y contra
+    # comparar el termino con todo el vocabulario.
+    parser = argparse.ArgumentParser(description='Benchmark of the spelling suggester.')
+    parser.add_argument('vocabulary', metavar='vocabulary', type=str,
+                        help='vocabulary file (vocabulary.txt of an index).')
+    parser.add_argument('-n', '--queries', dest='queries', type=int, default=50,
+                        help='number of misspelled terms.')
+    parser.add_argument('-t', '--threshold', dest='threshold', type=int, default=2)
+    parser.add_argument('-a', '--algorithm', dest='algorithm', type=str, default="levenshtein")
+    args = parser.parse_args()
+
+    with open(args.vocabulary, encoding='utf-8') as fh:
+        vocabulary = fh.read().split()
+    rnd = random.Random(0)
+    terms = []
+    for word in rnd.sample(vocabulary, args.queries):
+        k = rnd.randrange(len(word))
+        terms.append(word[:k] + rnd.choice("aeiourst") + word[k + 1:])
+
+    def bench(name, suggest):
+        t0 = time.time()
+        found = [suggest(term) for term in terms]
+        t = time.time() - t0
+        print("{:<14} {:8.2f} ms/query".format(name, 1000 * t / len(terms)))
+        return found
+
+    t0 = time.time()
+    trie = TrieSuggester(vocabulary)
+    print("{} words, trie with {} nodes built in {:.2f}s".format(len(trie), len(trie.labels), time.time() - t0))
+    fast = bench("trie", lambda term: trie.suggest(term, args.threshold, args.algorithm))
+    try:
+        import spellsuggest
+        sp = spellsuggest.TrieSpellSuggester(args.vocabulary)
+        bench("spellsuggest", lambda term: sp.suggest(term, threshold=args.threshold, distance=args.algorithm))
+    except ImportError:
+        print("spellsuggest not available")
+    slow = bench("full scan", lambda term: {w: d for w in vocabulary
+                                            if abs(len(w) - len(term)) <= args.threshold
+                                            for d in [distance(term, w, args.algorithm)] if d <= args.threshold})
+    print("same results:", fast == slow)
@@ -0,0 +1,432 @@
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+
+from SAR_lexicon import Lexicon
+from SAR_permuterm import PermutermIndex
+from SAR_postings import BitmapPostingList, CompressedPostingList
+
+
+"""
+Formato en disco del indice (un directorio):
+
+    meta.pkl       -> version del formato, estado de SAR_Project (sin los indices, las columnas
+                      ni los permuterm), la descripcion de cada tabla (tipo de indice, campo,
+                      numero de terminos, offset, columnas) y la de cada permuterm (campo,
+                      numero de rotaciones, offset)
+    terms.bin      -> lexicon de todos los terminos de todas las tablas (SAR_lexicon, front coding)
+                      y por cada tabla:
+                          ids[n] (uint32, ids de sus terminos en el lexicon, en orden)
+                          post_offs[n+1], pos_offs[n+1]  (uint64)
+                          una columna float64[n] por cada valor por termino (idf, cota de WAND...)
+                      y por cada permuterm (SAR_permuterm) sus rotaciones ordenadas:
+                          term_ids[m] (uint32, ids del lexicon), shifts[m] (uint16)
+    postings.bin   -> por cada termino su CompressedPostingList:
+                          n, npos, nblocks, nbitmap, last_ids[nblocks], id_offs[nblocks+1], pos_offs[nblocks+1] (uint32)
+                          bitmap de documentos (nbitmap bytes, solo los terminos frecuentes)
+                          bloques de ids y frecuencias (variable-byte)
+    positions.bin  -> por cada termino los bloques de posiciones (variable-byte)
+    store.bin      -> document store: un registro (json comprimido con zlib) por noticia
+    store.idx      -> offsets de los registros de store.bin, indexados por news_id (uint64)
+    vocabulary.txt -> vocabulario de todos los campos, una palabra por linea
+    suggester.pkl  -> corrector ortografico (SAR_spell.TrieSuggester) del vocabulario
+
+Los tres .bin se abren con mmap, de forma que cargar el indice solo lee meta.pkl y
+las posting lists se decodifican, bloque a bloque, cuando get_posting las pide.
+"""
+
+FORMAT_VERSION = 6
+
+META_FILE = "meta.pkl"
+TERMS_FILE = "terms.bin"
+POSTINGS_FILE = "postings.bin"
+POSITIONS_FILE = "positions.bin"
+STORE_FILE = "store.bin"
+STORE_INDEX_FILE = "store.idx"
+VOCABULARY_FILE = "vocabulary.txt"
+SUGGESTER_FILE = "suggester.pkl"
+
+
+def _align(fh, size=8):
+    # los arrays de offsets se leen con memoryview.cast, mejor alineados
+    pad = -fh.tell() % size
+    if pad:
+        fh.write(b"\0" * pad)
+
+
+def _to_disk(arr):
+    # el formato en disco es little-endian
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr
+
+
+def _from_disk(arr):
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+def _view(buf, start, count, typecode):
+    # array de "count" elementos en buf[start:], sin copiar si el orden de bytes es el del disco
+    size = array(typecode).itemsize * count
+    if count == 0:
+        return array(typecode)
+    if sys.byteorder == "little":
+        return memoryview(buf)[start:start + size].cast(typecode)
+    return _from_disk(array(typecode, buf[start:start + size]))
+
+
+def save_index(project, path, tables, transient=(), columns=None, permuterms=None):
+    """
+    Guarda el indice en el directorio "path".
+
+    param:  "project": objeto SAR_Project, se guarda su estado salvo las tablas y las columnas
+            "tables": diccionario (tipo, campo) -> {termino: PostingList o CompressedPostingList}
+            "transient": atributos de "project" que no se guardan (caches...)
+            "columns": diccionario nombre -> atributo de "project" {campo: {termino: float}}, se
+                       guardan como columnas de las tablas ("index", campo) y no en meta.pkl
+            "permuterms": diccionario campo -> PermutermIndex, se guardan sus rotaciones con los
+                          ids del lexicon
+
+    Los ficheros se escriben con un nombre temporal y se renombran al final,
+    asi un indice abierto con mmap no ve nunca ficheros a medias.
+    """
+    columns = columns or {}
+    permuterms = permuterms or {}
+    os.makedirs(path, exist_ok=True)
+    tmp = lambda name: os.path.join(path, name + ".tmp")
+    # lexicon comun: el id de un termino es su posicion en el orden de todos los terminos
+    lexicon = sorted(set().union(*tables.values()))
+    term_id = {term: i for i, term in enumerate(lexicon)}
+    described = {}
+    with open(tmp(TERMS_FILE), "wb") as tf, \
+         open(tmp(POSTINGS_FILE), "wb") as pf, \
+         open(tmp(POSITIONS_FILE), "wb") as sf:
+        tf.write(Lexicon.build(lexicon))
+        del lexicon
+        for key, table in tables.items():
+            terms = sorted(table)
+            ids = array("I", [term_id[term] for term in terms])
+            post_offs = array("Q", [pf.tell()])
+            pos_offs = array("Q", [sf.tell()])
+            for term in terms:
+                plist = table[term].compress()
+                bitmap = b""
+                if isinstance(plist, BitmapPostingList):
+                    bitmap = plist.to_bytes()
+                    plist = plist.payload
+                pf.write(struct.pack("<IIII", plist.n, plist.npos, plist.nblocks(), len(bitmap)))
+                pf.write(bitmap)
+                for arr in (plist.last_ids, plist.id_offs, plist.pos_offs):
+                    _to_disk(arr).tofile(pf)
+                pf.write(plist.data)
+                sf.write(plist.pos_data)
+                post_offs.append(pf.tell())
+                pos_offs.append(sf.tell())
+            names = tuple(name for name, values in columns.items() if key[0] == "index" and key[1] in values)
+            _align(tf)
+            described[key] = (len(terms), tf.tell(), names)
+            _to_disk(ids).tofile(tf)
+            _align(tf)
+            for arr in (post_offs, pos_offs):
+                _to_disk(arr).tofile(tf)
+            for name in names:
+                values = columns[name][key[1]]
+                _to_disk(array("d", [values[term] for term in terms])).tofile(tf)
+        rotations = {}
+        for field, pt in permuterms.items():
+            _align(tf)
+            rotations[field] = (len(pt), tf.tell())
+            _to_disk(array("I", [term_id[pt.terms[i]] for i in pt.term_ids])).tofile(tf)
+            _to_disk(array("H", pt.shifts)).tofile(tf)
+
+    skip = {"index", "sindex", "store", "ptindex"}.union(transient, columns)
+    state = {k: v for k, v in project.__dict__.items() if k not in skip}
+    with open(tmp(META_FILE), "wb") as fh:
+        pickle.dump({"version": FORMAT_VERSION, "state": state, "tables": described,
+                     "columns": tuple(columns), "permuterms": rotations}, fh)
+
+    project.store.save(path)
+    for name in (TERMS_FILE, POSTINGS_FILE, POSITIONS_FILE, META_FILE):
+        os.replace(tmp(name), os.path.join(path, name))
+
+
+def _open_mmap(filename):
+    with open(filename, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class IndexFiles:
+    """
+    Ficheros mmap de un indice en disco, compartidos por todas sus tablas.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE), "rb") as fh:
+            self.meta = pickle.load(fh)
+        if self.meta.get("version") != FORMAT_VERSION:
+            raise Exception("load_index: version de indice {} no soportada (se esperaba {}), vuelve a crearlo con SAR_Indexer.py".format(
+                self.meta.get("version"), FORMAT_VERSION))
+        self.terms = _open_mmap(os.path.join(path, TERMS_FILE))
+        self.postings = _open_mmap(os.path.join(path, POSTINGS_FILE))
+        self.positions = _open_mmap(os.path.join(path, POSITIONS_FILE))
+        self.lexicon = Lexicon(self.terms)
+
+    def table(self, key):
+        n, offset, columns = self.meta["tables"][key]
+        return DiskTable(self, n, offset, columns)
+
+    def permuterm(self, field):
+        # las rotaciones se quedan en el mmap, los terminos salen del lexicon
+        n, offset = self.meta["permuterms"][field]
+        rotations = (_view(self.terms, offset, n, "I"), _view(self.terms, offset + 4 * n, n, "H"))
+        return PermutermIndex(self.lexicon, rotations=rotations)
+
+
+class DiskTable(Mapping):
+    """
+    Diccionario termino -> CompressedPostingList (o BitmapPostingList) de solo lectura sobre los ficheros mmap.
+
+    Un termino se busca en el lexicon (IndexFiles.lexicon) y su id con una busqueda binaria en
+    los ids de la tabla; los bloques de la posting list se leen del mmap solo cuando se decodifican.
+    """
+
+    def __init__(self, files, n, offset, columns=()):
+        self.files = files
+        self.lexicon = files.lexicon
+        self.n = n
+        self.ids = _view(files.terms, offset, n, "I")
+        offset += 4 * n + (-4 * n) % 8
+        self.post_offs = _view(files.terms, offset, n + 1, "Q")
+        self.pos_offs = _view(files.terms, offset + 8 * (n + 1), n + 1, "Q")
+        offset += 16 * (n + 1)
+        self.columns = {}
+        for name in columns:
+            self.columns[name] = _view(files.terms, offset, n, "d")
+            offset += 8 * n
+
+    def _term(self, i):
+        return self.lexicon.term(self.ids[i])
+
+    def _find(self, term):
+        tid = self.lexicon.id(term)
+        if tid < 0:
+            return -1
+        i = bisect_left(self.ids, tid)
+        if i < self.n and self.ids[i] == tid:
+            return i
+        return -1
+
+    def prefix(self, prefix):
+        """
+        Terminos de la tabla que empiezan por "prefix", en orden (un rango de ids del lexicon).
+        """
+        lo, hi = self.lexicon.prefix_range(prefix)
+        for i in range(bisect_left(self.ids, lo), bisect_left(self.ids, hi)):
+            yield self._term(i)
+
+    def column(self, name):
+        return DiskColumn(self, self.columns[name])
+
+    def _decode(self, i):
+        # Solo se leen las cabeceras de bloque; los bloques se quedan en el mmap
+        # y se decodifican cuando se recorren
+        start, end = self.post_offs[i], self.post_offs[i + 1]
+        raw = self.files.postings
+        plist = CompressedPostingList()
+        plist.n, plist.npos, nblocks, nbitmap = struct.unpack_from("<IIII", raw, start)
+        p = start + 16
+        bits = int.from_bytes(raw[p:p + nbitmap], "little") if nbitmap else None
+        p += nbitmap
+        plist.last_ids = _from_disk(array("I", raw[p:p + 4 * nblocks]))
+        p += 4 * nblocks
+        plist.id_offs = _from_disk(array("I", raw[p:p + 4 * (nblocks + 1)]))
+        p += 4 * (nblocks + 1)
+        plist.pos_offs = _from_disk(array("I", raw[p:p + 4 * (nblocks + 1)]))
+        p += 4 * (nblocks + 1)
+        plist.data = memoryview(raw)[p:end]
+        plist.pos_data = memoryview(self.files.positions)[self.pos_offs[i]:self.pos_offs[i + 1]]
+        if bits is not None:
+            return BitmapPostingList(bits, plist)
+        return plist
+
+    def __getitem__(self, term):
+        i = self._find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self._decode(i)
+
+    def __contains__(self, term):
+        return self._find(term) >= 0
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self._term(i)
+
+    def items(self):
+        for i in range(self.n):
+            yield self._term(i), self._decode(i)
+
+    def values(self):
+        for i in range(self.n):
+            yield self._decode(i)
+
+
+class DiskColumn(Mapping):
+    """
+    Diccionario termino -> float de solo lectura con una columna de una DiskTable.
+    """
+
+    def __init__(self, table, data):
+        self.table = table
+        self.data = data
+
+    def __getitem__(self, term):
+        i = self.table._find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self.data[i]
+
+    def __contains__(self, term):
+        return self.table._find(term) >= 0
+
+    def __len__(self):
+        return self.table.n
+
+    def __iter__(self):
+        return iter(self.table)
+
+
+class DocStore:
+    """
+    Almacen de los campos que se muestran de cada noticia (id, title, date, keywords, article)
+    y de los offsets de los tokens del articulo ("spans"), para construir los snippets.
+
+    Cada noticia es un registro json comprimido con zlib; el registro de news_id k esta en
+    data[offsets[k-1]:offsets[k]], asi que mostrar un resultado cuesta un solo acceso.
+    Los news_id empiezan en 1 y son consecutivos (las noticias borradas con --update
+    dejan su registro, que ya no se referencia).
+    """
+
+    stored_fields = ("id", "title", "date", "keywords", "article")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array("Q", [0])
+
+    def add(self, news_id, noticia, spans=None):
+        """
+        Guarda la noticia "news_id", que debe ser la siguiente a la ultima guardada.
+
+        "spans": por cada token del articulo, distancia desde el final del token anterior
+        hasta su inicio y longitud (en caracteres)
+        """
+        if news_id != len(self.offsets):
+            raise Exception("DocStore.add: se esperaba la noticia {} y no la {}".format(len(self.offsets), news_id))
+        record = {field: noticia.get(field) for field in self.stored_fields}
+        if spans is not None:
+            record["spans"] = spans
+        self._writable().extend(zlib.compress(json.dumps(record, ensure_ascii=False).encode("utf-8")))
+        self.offsets.append(len(self.data))
+
+    def extend(self, other):
+        """
+        Añade al final los registros de otro DocStore (indices parciales de index_parallel).
+        """
+        base = len(self.data)
+        self._writable().extend(other.data)
+        self.offsets.extend(array("Q", map(base.__add__, other.offsets[1:])))
+
+    def get(self, news_id):
+        """
+        return: diccionario con los campos guardados de la noticia "news_id"
+        """
+        record = self.data[self.offsets[news_id - 1]:self.offsets[news_id]]
+        return json.loads(zlib.decompress(record).decode("utf-8"))
+
+    def nbytes(self):
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+    def _writable(self):
+        # un store abierto de disco es un mmap de solo lectura, para añadir se pasa a memoria
+        if not isinstance(self.data, bytearray):
+            self.data = bytearray(self.data)
+            self.offsets = array("Q", self.offsets)
+        return self.data
+
+    def save(self, path):
+        tmp = os.path.join(path, STORE_FILE + ".tmp")
+        with open(tmp, "wb") as fh:
+            fh.write(self.data)
+        tmp_idx = os.path.join(path, STORE_INDEX_FILE + ".tmp")
+        with open(tmp_idx, "wb") as fh:
+            _to_disk(array("Q", self.offsets)).tofile(fh)
+        os.replace(tmp, os.path.join(path, STORE_FILE))
+        os.replace(tmp_idx, os.path.join(path, STORE_INDEX_FILE))
+
+    @classmethod
+    def open(cls, path):
+        """
+        Abre con mmap un store guardado con "save".
+        """
+        store = cls.__new__(cls)
+        store.data = _open_mmap(os.path.join(path, STORE_FILE))
+        index = _open_mmap(os.path.join(path, STORE_INDEX_FILE))
+        if sys.byteorder == "little":
+            store.offsets = memoryview(index).cast("Q")
+        else:
+            store.offsets = _from_disk(array("Q", index))
+        return store
+
+
+def load_index(path):
+    """
+    Abre un indice guardado con save_index.
+
+    return: (estado de SAR_Project, IndexFiles, DocStore)
+    """
+    files = IndexFiles(path)
+    return files.meta["state"], files, DocStore.open(path)
+
+
+def save_suggester(path, vocabulary, build):
+    """
+    Escribe el vocabulario en el directorio del indice y guarda el corrector construido con el.
+
+    param:  "vocabulary": palabras del indice
+            "build": funcion (vocabulario) -> corrector
+    """
+    vocab_file = os.path.join(path, VOCABULARY_FILE)
+    with open(vocab_file, "w", encoding="utf-8") as fh:
+        for word in sorted(vocabulary):
+            fh.write(word + "\n")
+    suggester = build(vocabulary)
+    tmp = os.path.join(path, SUGGESTER_FILE + ".tmp")
+    with open(tmp, "wb") as fh:
+        pickle.dump(suggester, fh)
+    os.replace(tmp, os.path.join(path, SUGGESTER_FILE))
+
+
+def load_suggester(path):
+    """
+    return: el corrector guardado con save_suggester o None si el indice no lo tiene
+    """
+    filename = os.path.join(path, SUGGESTER_FILE)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as fh:
+        return pickle.load(fh)
@@ -0,0 +1,332 @@
+import json
+import random
+import re
+from bisect import bisect_left
+
+import pytest
+
+import SAR_lexicon
+from SAR_lexicon import Lexicon
+from SAR_lib import SAR_Project
+from SAR_permuterm import PermutermIndex
+from SAR_postings import PostingList, CompressedPostingList, PostingCursor, gallop, vbyte_decode, vbyte_encode
+from SAR_spell import TrieSuggester, distance
+
+
+"""
+Pruebas deterministas de las estructuras del indice contra una version de fuerza bruta.
+
+Los datos se generan con un random.Random con semilla fija, asi cada ejecucion prueba
+los mismos casos. Ejecutar con:
+
+    python -m pytest -q SAR_test.py
+"""
+
+BLOCK = CompressedPostingList.BLOCK_SIZE
+
+# tamaños alrededor de los limites de bloque de CompressedPostingList
+SIZES = [0, 1, 2, BLOCK - 1, BLOCK, BLOCK + 1, 2 * BLOCK, 2 * BLOCK + 1, 5 * BLOCK + 37]
+
+
+def random_postings(rng, n, positions=False, max_gap=40):
+    """
+    PostingList con "n" news_id crecientes, frecuencias y (con "positions") posiciones aleatorias.
+    """
+    plist = PostingList()
+    news_id = 0
+    for _ in range(n):
+        news_id += rng.randint(1, max_gap)
+        if positions:
+            pos = sorted(rng.sample(range(1, 500), rng.randint(1, 6)))
+            plist.append(news_id, len(pos), pos)
+        else:
+            plist.append(news_id, rng.randint(1, 9))
+    return plist
+
+
+########################
+## SAR_postings
+########################
+
+def test_vbyte_round_trip():
+    rng = random.Random(7)
+    values = [0, 1, 127, 128, 129, 16383, 16384, 2 ** 21 - 1, 2 ** 21, 2 ** 32 - 1]
+    values += [rng.randrange(2 ** rng.randint(1, 32)) for _ in range(1000)]
+    data = bytearray()
+    vbyte_encode(values, data)
+    decoded, pos = vbyte_decode(data, 0, len(values))
+    assert list(decoded) == values
+    assert pos == len(data)
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("positions", [False, True])
+def test_compressed_round_trip(n, positions):
+    rng = random.Random(n * 2 + positions)
+    plist = random_postings(rng, n, positions)
+    comp = CompressedPostingList.from_postings(plist)
+    assert len(comp) == n
+    assert comp.nblocks() == (n + BLOCK - 1) // BLOCK
+    assert comp.decode() == plist
+    assert list(comp.news_ids()) == list(plist.ids)
+    for b in range(comp.nblocks()):
+        expected = plist.ids[b * BLOCK:(b + 1) * BLOCK]
+        assert list(comp.block_ids(b)) == list(expected)
+        assert comp.last_ids[b] == expected[-1]
+        assert list(comp.block(b, positions=False).freqs) == list(plist.freqs[b * BLOCK:(b + 1) * BLOCK])
+    assert comp.raw_nbytes() == plist.nbytes()
+
+
+def test_gallop():
+    rng = random.Random(11)
+    for n in [0, 1, 2, 3, 10, BLOCK, 1000]:
+        ids = sorted(rng.sample(range(5 * n + 10), n))
+        for _ in range(200):
+            x = rng.randrange(-2, 5 * n + 12)
+            lo = rng.randint(0, n)
+            assert gallop(ids, x, lo) == max(lo, bisect_left(ids, x)), (n, x, lo)
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("compressed", [False, True])
+@pytest.mark.parametrize("full", [False, True])
+def test_cursor_next_geq(n, compressed, full):
+    rng = random.Random(1000 + n)
+    plist = random_postings(rng, n, positions=full)
+    source = plist.compress() if compressed else plist
+    ids = list(plist.ids)
+    end = (ids[-1] if ids else 0) + 10
+    for run in range(20):
+        cursor = PostingCursor(source, full=full)
+        x = 0
+        # saltos cortos (dentro del bloque) y largos (varios bloques de golpe)
+        while True:
+            x += rng.choice([0, 1, 2, rng.randint(1, 60), rng.randint(1, 40 * BLOCK)])
+            got = cursor.next_geq(x)
+            k = bisect_left(ids, x)
+            if k == len(ids):
+                assert got is None, (n, x)
+                break
+            assert got == ids[k], (n, x)
+            if full:
+                assert cursor.freq() == plist.freqs[k]
+                assert list(cursor.chunk.get_pos(cursor.i)) == list(plist.get_pos(k))
+            if x > end:
+                break
+
+
+########################
+## SAR_permuterm
+########################
+
+ALPHABET = "aabcdeeinosñá"
+
+
+def random_word(rng, lo=1, hi=8):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(lo, hi)))
+
+
+def random_pattern(rng, words):
+    """
+    Patron con comodines: sale de un termino (para que tenga resultados) o es aleatorio,
+    y se le cambian letras por "?" y trozos por "*".
+    """
+    word = list(rng.choice(words) if rng.random() < 0.7 else random_word(rng))
+    for _ in range(rng.randint(0, 3)):
+        if not word:
+            break
+        k = rng.randrange(len(word))
+        if rng.random() < 0.5:
+            word[k] = "?"
+        else:
+            word[k:k + rng.randint(0, 3)] = ["*"]
+    return "".join(word)
+
+
+def brute_expand(words, pattern):
+    regex = re.compile("".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in pattern))
+    return sorted(word for word in words if regex.fullmatch(word))
+
+
+def test_permuterm_expand():
+    rng = random.Random(14)
+    words = sorted({random_word(rng) for _ in range(800)}) # el vocabulario no tiene repetidos
+    index = PermutermIndex(words)
+    assert len(index) == sum(len(word) + 1 for word in words)
+    patterns = ["*", "?", "??", "*?*", "a*", "*a", "*a*", "a*a", "a?*", "*ñ?", "zzz", "",
+                words[0], words[1] + "x", "*" + words[2], words[3] + "*"]
+    patterns += [random_pattern(rng, words) for _ in range(1500)]
+    for pattern in patterns:
+        assert index.expand(pattern) == brute_expand(words, pattern), pattern
+
+
+########################
+## SAR_spell
+########################
+
+DISTANCE_NAMES = ["levenshtein", "restricted", "intermediate"]
+
+def test_distance_reference():
+    # casos a mano de cada distancia: intercambio (ab <-> ba) y ab <-> bXa
+    assert [distance("ab", "ba", name) for name in DISTANCE_NAMES] == [2, 1, 1]
+    assert [distance("ab", "bca", name) for name in DISTANCE_NAMES] == [3, 3, 2]
+    assert [distance("casa", "cosa", name) for name in DISTANCE_NAMES] == [1, 1, 1]
+    assert [distance("", "abc", name) for name in DISTANCE_NAMES] == [3, 3, 3]
+
+
+@pytest.mark.parametrize("name", DISTANCE_NAMES)
+def test_trie_suggest(name):
+    rng = random.Random(16)
+    vocabulary = sorted({random_word(rng, 1, 9) for _ in range(250)})
+    suggester = TrieSuggester(vocabulary)
+    assert len(suggester) == len(vocabulary)
+    terms = ["", "a", "ñ", "aaaaaaaaaaaa"] + [random_word(rng, 1, 10) for _ in range(20)]
+    for word in rng.sample(vocabulary, 25):
+        # el propio termino, con una letra cambiada o con dos letras seguidas intercambiadas
+        k = rng.randrange(len(word))
+        terms.append(word)
+        terms.append(word[:k] + rng.choice(ALPHABET) + word[k + 1:])
+        if len(word) > 1:
+            k = rng.randrange(len(word) - 1)
+            terms.append(word[:k] + word[k + 1] + word[k] + word[k + 2:])
+    for term in terms:
+        distances = {word: distance(term, word, name) for word in vocabulary}
+        for threshold in (1, 2, 3):
+            expected = {word: d for word, d in distances.items() if d <= threshold}
+            assert suggester.suggest(term, threshold, name) == expected, (term, threshold)
+
+
+########################
+## Ranking (WAND)
+########################
+
+@pytest.fixture(scope="module")
+def project(tmp_path_factory):
+    """
+    Indice multifield, posicional, con stems y permuterm de una coleccion sintetica de 900 noticias
+    (palabras con frecuencias de Zipf, asi hay terminos en bitmap y en varios bloques).
+    """
+    rng = random.Random(18)
+    words = sorted({random_word(rng, 3, 8) for _ in range(300)})
+    rng.shuffle(words)
+    weights = [1 / (r + 1) for r in range(len(words))]
+    root = tmp_path_factory.mktemp("news")
+    news_id = 0
+    for f in range(3):
+        news = []
+        for _ in range(300):
+            news_id += 1
+            text = lambda n: " ".join(rng.choices(words, weights, k=rng.randint(1, n)))
+            news.append({"id": str(news_id), "title": text(8), "keywords": text(4), "article": text(150),
+                         "summary": text(30), "date": "2015-01-01", "url": ""})
+        with open(root / "news{}.json".format(f), "w") as fh:
+            json.dump(news, fh)
+    project = SAR_Project()
+    project.index_dir(str(root), multifield=True, positional=True, stem=True, permuterm=True)
+    project.words = words
+    return project
+
+
+def brute_rank(project, terms):
+    """
+    Ranking BM25 de todas las noticias de las posting lists de "terms", sin cotas ni cursores.
+    Suma las puntuaciones con las mismas operaciones que rank_result, asi los empates son exactos.
+
+    return: lista de (newid, puntuacion) de mayor a menor puntuacion (empates por newid)
+    """
+    k1 = project.BM25_K1
+    norm = k1 * (1 - project.BM25_B)
+    scores = {}
+    for term, field in terms:
+        plist = project.get_posting(term, field).decode()
+        idf = project.term_idf(term, field, len(plist))
+        lengths = project.doc_len[field]
+        slope = k1 * project.BM25_B / max(project.avgdl.get(field, 0), 1)
+        for news_id, tf in zip(plist.ids, plist.freqs):
+            scores[news_id] = scores.get(news_id, 0.0) + idf * tf * (k1 + 1) / (tf + norm + slope * lengths[news_id])
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def random_disjunction(rng, words):
+    parts = []
+    for _ in range(rng.randint(1, 5)):
+        # los terminos frecuentes estan al principio de "words"
+        word = words[min(int(rng.expovariate(1 / 40)), len(words) - 1)]
+        kind = rng.random()
+        if kind < 0.1:
+            word = word[:2] + "*"
+        elif kind < 0.15:
+            word = '"{} {}"'.format(word, rng.choice(words[:20]))
+        elif kind < 0.2:
+            word = "zzz" + word # no esta en el indice
+        if rng.random() < 0.3:
+            word = rng.choice(["title", "summary", "keywords"]) + ":" + word
+        parts.append(word)
+    return " OR ".join(parts)
+
+
+@pytest.mark.parametrize("stemming", [False, True])
+def test_rank_wand(project, stemming):
+    rng = random.Random(180 + stemming)
+    project.set_stemming(stemming)
+    try:
+        for _ in range(150):
+            query = random_disjunction(rng, project.words)
+            terms, disjunctive = project.ranking_terms(query, with_kind=True)
+            assert disjunctive
+            ranked = [news_id for news_id, _ in brute_rank(project, terms)]
+            for k in (1, 3, 10, 50):
+                assert project.rank_wand(terms, k) == ranked[:k], (query, k)
+    finally:
+        project.set_stemming(False)
+
+
+########################
+## SAR_lexicon
+########################
+
+LEX_BLOCK = SAR_lexicon.BLOCK
+
+@pytest.mark.parametrize("n", [0, 1, LEX_BLOCK - 1, LEX_BLOCK, LEX_BLOCK + 1, 2 * LEX_BLOCK, 700])
+def test_lexicon(n, monkeypatch):
+    # caches pequeñas para que se vacien durante la prueba
+    monkeypatch.setattr(SAR_lexicon, "BLOCK_CACHE_SIZE", 3)
+    monkeypatch.setattr(SAR_lexicon, "ID_CACHE_SIZE", 5)
+    rng = random.Random(25 + n)
+    terms = set()
+    while len(terms) < n:
+        # prefijos compartidos y letras de 1 a 4 bytes en utf-8
+        terms.add(random_word(rng, 1, 6) + rng.choice(["", "a", "ab", "é", "€", "😀", "z"]))
+    terms = sorted(terms)
+    header = b"cabecera"
+    lexicon = Lexicon(header + Lexicon.build(terms), len(header))
+    assert len(lexicon) == n
+    assert list(lexicon) == terms
+    assert [lexicon[i] for i in range(n)] == terms
+    assert lexicon.nbytes == len(Lexicon.build(terms))
+    keys = [term.encode("utf-8") for term in terms]
+    for term in terms + [random_word(rng) for _ in range(200)] + ["", "a", "zzzz", "😀"]:
+        k = bisect_left(terms, term)
+        found = k < n and terms[k] == term
+        assert lexicon.id(term) == (k if found else -1), term
+        assert (term in lexicon) == found
+        assert lexicon.lower_bound(term.encode("utf-8")) == bisect_left(keys, term.encode("utf-8"))
+    for prefix in ["", "a", "ab", "ñ", "á", "zz"] + [term[:rng.randint(1, len(term))] for term in rng.sample(terms, min(n, 100))]:
+        lo, hi = lexicon.prefix_range(prefix)
+        assert terms[lo:hi] == [term for term in terms if term.startswith(prefix)], prefix
+
+
+def test_permuterm_on_lexicon():
+    rng = random.Random(250)
+    words = sorted({random_word(rng) for _ in range(600)})
+    lexicon = Lexicon(Lexicon.build(words))
+    # solo se indexan algunos terminos del lexicon, como los de un campo
+    ids = sorted(rng.sample(range(len(words)), 400))
+    index = PermutermIndex(lexicon, ids)
+    loaded = PermutermIndex(lexicon, rotations=(index.term_ids, index.shifts))
+    indexed = [words[i] for i in ids]
+    for _ in range(500):
+        pattern = random_pattern(rng, indexed)
+        expected = brute_expand(indexed, pattern)
+        assert index.expand(pattern) == expected, pattern
+        assert loaded.expand(pattern) == expected, pattern